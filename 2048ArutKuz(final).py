@@ -2,6 +2,32 @@ import pygame
 import random
 import sys
 import sqlite3
+import os
+import mmap
+import struct
+import threading
+import time
+import hashlib
+import json
+import argparse
+import socketserver
+import multiprocessing
+import queue
+import signal
+import math
+import bisect
+import cProfile
+import pstats
+import tempfile
+import shutil
+from array import array
+from collections import OrderedDict, deque
+from itertools import chain
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 GRID_SIZE = 4
 TILE_DIMENSION = 100
@@ -10,6 +36,75 @@ HEADER_HEIGHT = 120
 BOARD_SIZE = GRID_SIZE * (TILE_DIMENSION + GAP_SIZE) + GAP_SIZE
 WINDOW_WIDTH = BOARD_SIZE
 WINDOW_HEIGHT = HEADER_HEIGHT + BOARD_SIZE
+FPS = 60
+ANIMATION_FPS = 144
+ANIMATION_TIME = 0.1
+RESIZE_DELAY = 0.15
+LOGIC_STEP = 1 / 120
+MAX_LOGIC_STEPS = 4
+INPUT_QUEUE_SIZE = 8
+KEY_REPEAT = (200, 60)
+MIN_WINDOW_SIZE = (300, 360)
+BOARD_SIZES = (4, 5, 6)
+PROFILE_PHASES = ("events", "logic", "header", "board", "present")
+PROFILE_HISTORY = 3600
+SAMPLE_INTERVAL = 0.005
+PROFILE_REPORT_LINES = 40
+TEXT_CACHE_SIZE = 256
+METRICS_PATH = "2048.prom"
+METRICS_INTERVAL = 10.0
+FRAME_BUCKETS = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066)
+DB_WRITE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+BENCH_SCRIPT_PATH = "bench_script.json"
+BENCH_BASELINE_PATH = "bench_baseline.json"
+BENCH_TOLERANCE = 0.25
+SPECTATOR_BOARDS = 36
+SPECTATOR_INTERVAL = 1 / 30
+SPECTATOR_QUEUE_SIZE = 64
+SPECTATOR_SPAWN_BATCH = 256
+SPECTATOR_STATUS_HEIGHT = 30
+
+MOVES = ("left", "right", "up", "down")
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<BBIIII")
+REPLAY_SPAWN_VERSION = 2
+SPAWN_ENTRY = struct.Struct("<Bd")
+SPAWN_BATCH = 4096
+TABLEBASE_MAGIC = b"TB48"
+TABLEBASE_HEADER = struct.Struct("<4sBBBBQ")
+TABLEBASE_DENSE_LIMIT = 1 << 20
+TABLEBASE_WIN_TILES = {2: 32, 3: 64}
+TT_MAGIC = b"TT48"
+TT_VERSION = 2
+TT_HEADER = struct.Struct("<4sBBxxQQ")
+TT_ENTRY = struct.Struct("<QQQ")
+TT_SLOTS = 1 << 20
+TT_HASH = 0x9E3779B97F4A7C15
+TT_OPENING_PLIES = 2
+TUNE_WEIGHTS = ("empty", "merges", "monotonicity", "sum")
+TUNE_POPULATION = 32
+TUNE_GAMES = 64
+TUNE_ELITE = 0.25
+TUNE_SIGMA = 0.5
+TUNE_MIN_SIGMA = 0.05
+TUNE_CHUNK = 8
+TUNE_CHECKPOINT = "tune_checkpoint.json"
+HEURISTIC_WEIGHTS = {"lost": 200000.0, "empty": 270.0, "merges": 700.0, "monotonicity": 47.0, "sum": 11.0}
+ARCHIVE_INDEX_RECORD = struct.Struct("<QI")
+SAVE_MAGIC = b"2048"
+SAVE_VERSION = 3
+SAVE_HEADER = struct.Struct("<4sBBQ")
+SAVE_FLAGS = struct.Struct("<?")
+RNG_STATE = struct.Struct("<625I?d")
+HISTORY_HEADER = struct.Struct("<?III")
+UNDO_CAPACITY = 100000
+SAVE_PATH = "savegame.bin"
+AUTOSAVE_INTERVAL = 1.0
+SUBMISSION_HEADER = struct.Struct("<HI")
+VERIFY_PORT = 20480
+NPY_HEADER_SIZE = 128
+SHARD_SIZE = 1 << 20
+TRAJECTORY_COLUMNS = (("states", "|u1", "B"), ("actions", "|u1", "B"), ("rewards", "<u4", "I"), ("dones", "|u1", "B"))
 
 THEMES = {
     "Классическая": {
@@ -66,9 +161,99 @@ THEMES = {
 }
 
 
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        # без блокировки: под GIL инкремент дешёвый, редкая потеря при записи из нескольких потоков допустима
+        self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f"{self.name}_sum {self.sum:.6f}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets):
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+class MetricsWriter:
+    def __init__(self, registry, path=METRICS_PATH, interval=METRICS_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            write_atomic(self.path, self.registry.render().encode("utf-8"))
+        except OSError:
+            pass
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+METRICS = MetricsRegistry()
+MOVES_TOTAL = METRICS.counter("game2048_moves_total", "Ходы, изменившие поле")
+MERGES_TOTAL = METRICS.counter("game2048_merges_total", "Слияния плиток")
+SPAWNS_TOTAL = METRICS.counter("game2048_spawns_total", "Появившиеся плитки")
+GAME_OVER_CHECKS_TOTAL = METRICS.counter("game2048_game_over_checks_total", "Вызовы Board.is_game_over")
+FRAME_SECONDS = METRICS.histogram("game2048_frame_seconds", "Время отрисовки кадра игры", FRAME_BUCKETS)
+DB_WRITE_SECONDS = METRICS.histogram("game2048_db_write_seconds", "Время записи в базу", DB_WRITE_BUCKETS)
+
+
 class DatabaseManager:
-    def __init__(self, db_path="highscore.db"):
-        self.conn = sqlite3.connect(db_path)
+    def __init__(self, db_path="highscore.db", check_same_thread=True):
+        self.conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
         self._init_db()
 
     def _init_db(self):
@@ -84,29 +269,463 @@ class DatabaseManager:
             self.high_score = row[0]
 
     def update_high_score(self, new_score):
+        started = time.perf_counter()
         cursor = self.conn.cursor()
         cursor.execute("UPDATE highscore SET score = ?", (new_score,))
         self.conn.commit()
         self.high_score = new_score
+        DB_WRITE_SECONDS.observe(time.perf_counter() - started)
+
+    def add_leaderboard_entry(self, name, score, max_tile, replay):
+        started = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS leaderboard (name TEXT, score INTEGER, max_tile INTEGER, "
+                       "replay_hash TEXT UNIQUE)")
+        try:
+            cursor.execute("INSERT INTO leaderboard (name, score, max_tile, replay_hash) VALUES (?, ?, ?, ?)",
+                           (name, score, max_tile, hashlib.sha1(replay.to_bytes()).hexdigest()))
+        except sqlite3.IntegrityError:
+            return False
+        self.conn.commit()
+        DB_WRITE_SECONDS.observe(time.perf_counter() - started)
+        return True
+
+    def top_scores(self, limit=10):
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS leaderboard (name TEXT, score INTEGER, max_tile INTEGER, "
+                       "replay_hash TEXT UNIQUE)")
+        cursor.execute("SELECT name, score, max_tile FROM leaderboard ORDER BY score DESC LIMIT ?", (limit,))
+        return cursor.fetchall()
 
     def close(self):
         self.conn.close()
 
 
+def pack_board(board):
+    packed = 0
+    shift = 0
+    for row in board:
+        for value in row:
+            if value:
+                exponent = value.bit_length() - 1
+                if exponent > 15:
+                    raise ValueError(f"tile {value} does not fit into a packed board")
+                packed |= exponent << shift
+            shift += 4
+    return packed
+
+
+def unpack_board(packed, grid_size):
+    board = []
+    for _ in range(grid_size):
+        row = []
+        for _ in range(grid_size):
+            exponent = packed & 15
+            row.append(1 << exponent if exponent else 0)
+            packed >>= 4
+        board.append(row)
+    return board
+
+
+class UndoHistory:
+    def __init__(self, grid_size, capacity=UNDO_CAPACITY):
+        self.grid_size = grid_size
+        self.capacity = capacity
+        self.width = (grid_size * grid_size + 1) // 2
+        self._states = bytearray()
+        self._deltas = array("H")
+        self._start = 0
+        self._cursor = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _store(self, position, packed, delta):
+        slot = position % self.capacity
+        scaled = delta >> 2
+        if scaled > 0xFFFF and self._deltas.typecode == "H":
+            self._deltas = array("I", self._deltas)
+        state = packed.to_bytes(self.width, "little")
+        if slot * self.width == len(self._states):
+            self._states += state
+            self._deltas.append(scaled)
+        else:
+            self._states[slot * self.width:(slot + 1) * self.width] = state
+            self._deltas[slot] = scaled
+
+    def _load(self, position):
+        slot = position % self.capacity
+        return int.from_bytes(self._states[slot * self.width:(slot + 1) * self.width], "little")
+
+    def reset(self, packed):
+        self._start = self._cursor = 0
+        self._end = 1
+        self._store(0, packed, 0)
+
+    def push(self, packed, delta):
+        self._cursor += 1
+        self._end = self._cursor + 1
+        if self._end - self._start > self.capacity:
+            self._start = self._end - self.capacity
+        self._store(self._cursor, packed, delta)
+
+    def can_undo(self):
+        return self._cursor > self._start
+
+    def can_redo(self):
+        return self._cursor + 1 < self._end
+
+    def undo(self):
+        if not self.can_undo():
+            return None
+        delta = self._deltas[self._cursor % self.capacity] << 2
+        self._cursor -= 1
+        return self._load(self._cursor), delta
+
+    def redo(self):
+        if not self.can_redo():
+            return None
+        self._cursor += 1
+        return self._load(self._cursor), self._deltas[self._cursor % self.capacity] << 2
+
+    def to_bytes(self, assisted):
+        # после заворота кольца записи лежат двумя кусками: от start до конца буфера и с начала
+        count = len(self)
+        first = self._start % self.capacity
+        head = min(count, self.capacity - first)
+        width = self.width
+        deltas = self._deltas[first:first + head] + self._deltas[:count - head]
+        header = HISTORY_HEADER.pack(assisted, self.capacity, len(self), self._cursor - self._start)
+        # представление отпускается сразу: пока оно живо, bytearray нельзя дописывать
+        with memoryview(self._states) as states:
+            return b"".join((header, states[first * width:(first + head) * width], states[:(count - head) * width],
+                             self._widen(deltas)))
+
+    @staticmethod
+    def _widen(deltas):
+        # в файле дельты всегда 32-битные; расширяем 16-битные срезами байтов, без цикла по записям
+        raw = deltas.tobytes()
+        if deltas.typecode == "I":
+            return raw
+        wide = bytearray(2 * len(raw))
+        offset = 0 if sys.byteorder == "little" else 2
+        wide[offset::4] = raw[0::2]
+        wide[offset + 1::4] = raw[1::2]
+        return wide
+
+    def copy(self):
+        history = UndoHistory.__new__(UndoHistory)
+        history.__dict__.update(self.__dict__)
+        history._states = bytearray(self._states)
+        history._deltas = self._deltas[:]
+        return history
+
+    @classmethod
+    def from_bytes(cls, data, grid_size):
+        assisted, capacity, count, cursor = HISTORY_HEADER.unpack_from(data)
+        history = cls(grid_size, capacity)
+        offset = HISTORY_HEADER.size
+        history._states = bytearray(data[offset:offset + count * history.width])
+        offset += count * history.width
+        history._deltas = array("I")
+        history._deltas.frombytes(data[offset:offset + count * 4])
+        history._end = count
+        history._cursor = cursor
+        return history, assisted
+
+
+class SpawnDistribution:
+    def __init__(self, weights):
+        pairs = sorted(dict(weights).items())
+        if not pairs or any(value < 2 or value & (value - 1) or weight <= 0 for value, weight in pairs):
+            raise ValueError("spawn values must be powers of two with positive weights")
+        total = sum(weight for _, weight in pairs)
+        self.values = tuple(value for value, _ in pairs)
+        self.weights = tuple(weight for _, weight in pairs)
+        self.exponents = tuple(value.bit_length() - 1 for value in self.values)
+        self.probabilities = tuple(weight / total for weight in self.weights)
+        self.outcomes = tuple(zip(self.exponents, self.probabilities))
+        # классическое 2/4 = 90/10 разыгрывается как раньше, чтобы старые реплеи и сохранения не поменялись
+        self.classic = self.values == (2, 4) and abs(self.probabilities[0] - 0.9) < 1e-12
+        count = len(pairs)
+        scaled = [probability * count for probability in self.probabilities]
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    @classmethod
+    def parse(cls, text):
+        weights = {}
+        for item in text.split(","):
+            value, _, weight = item.partition(":")
+            weights[int(value)] = float(weight or 1)
+        return cls(weights)
+
+    def sample(self, uniform):
+        if self.classic:
+            return 1 if uniform < 0.9 else 2
+        scaled = uniform * len(self.prob)
+        column = int(scaled)
+        return self.exponents[column if scaled - column < self.prob[column] else self.alias[column]]
+
+    def sample_array(self, uniforms):
+        import numpy
+        exponents = numpy.array(self.exponents, dtype=numpy.uint8)
+        if self.classic:
+            return numpy.where(uniforms < 0.9, exponents[0], exponents[1])
+        scaled = uniforms * len(self.prob)
+        columns = scaled.astype(numpy.intp)
+        keep = scaled - columns < numpy.array(self.prob)[columns]
+        return numpy.where(keep, exponents[columns], exponents[numpy.array(self.alias)[columns]])
+
+    def to_bytes(self):
+        return bytes([len(self.values)]) + b"".join(SPAWN_ENTRY.pack(exponent, weight)
+                                                    for exponent, weight in zip(self.exponents, self.weights))
+
+    @classmethod
+    def from_bytes(cls, buffer, offset=0):
+        count = buffer[offset]
+        entries = [SPAWN_ENTRY.unpack_from(buffer, offset + 1 + i * SPAWN_ENTRY.size) for i in range(count)]
+        return cls({1 << exponent: weight for exponent, weight in entries}), 1 + count * SPAWN_ENTRY.size
+
+
+CLASSIC_SPAWN = SpawnDistribution({2: 9, 4: 1})
+
+
+class SpawnStream:
+    def __init__(self, seed, batch=SPAWN_BATCH, vectorized=False):
+        self.rng = random.Random(seed)
+        self.batch = batch
+        self.vectorized = vectorized
+        if vectorized:
+            import numpy
+            self._generator = numpy.random.default_rng(seed)
+        self.buffer = []
+        self.index = 0
+
+    def _refill(self):
+        if self.vectorized:
+            self.buffer = self._generator.random(self.batch)
+        else:
+            draw = self.rng.random
+            self.buffer = [draw() for _ in range(self.batch)]
+        self.index = 0
+
+    def next(self):
+        if self.index >= len(self.buffer):
+            self._refill()
+        self.index += 1
+        return self.buffer[self.index - 1]
+
+    def take(self, count):
+        if self.vectorized:
+            import numpy
+            parts = []
+            while count:
+                if self.index >= len(self.buffer):
+                    self._refill()
+                part = self.buffer[self.index:self.index + count]
+                self.index += len(part)
+                count -= len(part)
+                parts.append(part)
+            return numpy.concatenate(parts) if parts else numpy.empty(0)
+        return [self.next() for _ in range(count)]
+
+
+def spawn_check_command(distribution, count, seed=0):
+    import numpy
+    # векторная выборка через поток и таблицу псевдонимов, сверка частот с заданными весами
+    stream = SpawnStream(seed, vectorized=True)
+    started = time.perf_counter()
+    counts = numpy.zeros(16, dtype=numpy.int64)
+    chunk = 16 * SPAWN_BATCH
+    # полные куски и остаток; остаток бывает пустым, take(0) это допускает
+    for size in [chunk] * (count // chunk) + [count % chunk]:
+        counts += numpy.bincount(distribution.sample_array(stream.take(size)), minlength=16)
+    elapsed = time.perf_counter() - started
+    ok = True
+    for value, exponent, probability in zip(distribution.values, distribution.exponents, distribution.probabilities):
+        if not count:
+            break
+        observed = counts[exponent] / count
+        error = math.sqrt(probability * (1 - probability) / count) or 1.0
+        deviation = (observed - probability) / error
+        ok = ok and abs(deviation) < 5
+        print(f"{value}: expected {probability:.4f}, observed {observed:.4f} ({deviation:+.1f} sigma)")
+    print(f"sampled {count} spawns in {elapsed:.2f}s ({count / max(elapsed, 1e-9) / 1e6:.1f}M/s)")
+    return ok
+
+
 class Board:
-    def __init__(self):
-        self.grid_size = GRID_SIZE
+    def __init__(self, grid_size=GRID_SIZE, seed=None, undo_capacity=0, spawn=CLASSIC_SPAWN):
+        self.grid_size = grid_size
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.spawn = spawn
         self.score = 0
+        self.moves = bytearray()
+        self.assisted = False
+        self.track_moves = False
+        self.last_moves = []
+        self.last_spawn = None
         self.board = [[0] * self.grid_size for _ in range(self.grid_size)]
         self.spawn_tile()
         self.spawn_tile()
+        self.history = None
+        if undo_capacity:
+            self.history = UndoHistory(grid_size, undo_capacity)
+            self.history.reset(pack_board(self.board))
 
     def spawn_tile(self):
         empty_positions = [(r, c) for r in range(self.grid_size)
                            for c in range(self.grid_size) if self.board[r][c] == 0]
         if empty_positions:
-            row, col = random.choice(empty_positions)
-            self.board[row][col] = 2 if random.random() < 0.9 else 4
+            row, col = self.rng.choice(empty_positions)
+            self.board[row][col] = 1 << self.spawn.sample(self.rng.random())
+            self.last_spawn = (row, col)
+            SPAWNS_TOTAL.inc()
+
+    def move(self, direction):
+        old_board = [row[:] for row in self.board]
+        old_score = self.score
+        if self.track_moves:
+            self._move_tracked(direction)
+        else:
+            getattr(self, "move_" + MOVES[direction])()
+        if self.board == old_board:
+            return False
+        MOVES_TOTAL.inc()
+        MERGES_TOTAL.inc(sum(map(bool, chain.from_iterable(old_board))) -
+                         sum(map(bool, chain.from_iterable(self.board))))
+        self.moves.append(direction)
+        self.spawn_tile()
+        if self.history is not None:
+            try:
+                self.history.push(pack_board(self.board), self.score - old_score)
+            except ValueError:
+                # плитка 65536 и выше не помещается в 4 бита: партия продолжается без истории отмены
+                self.history = None
+        return True
+
+    def _move_tracked(self, direction):
+        n = self.grid_size
+        new_board = [[0] * n for _ in range(n)]
+        self.last_moves = []
+        for i in range(n):
+            positions = range(n - 1, -1, -1) if direction in (1, 3) else range(n)
+            cells = [(i, j) if direction < 2 else (j, i) for j in positions]
+            tiles = [(self.board[r][c], (r, c)) for r, c in cells if self.board[r][c]]
+            target = 0
+            j = 0
+            while j < len(tiles):
+                value, source = tiles[j]
+                r, c = cells[target]
+                if j + 1 < len(tiles) and tiles[j + 1][0] == value:
+                    new_board[r][c] = value * 2
+                    self.score += value * 2
+                    self.last_moves.append((source, (r, c), value, True))
+                    self.last_moves.append((tiles[j + 1][1], (r, c), value, True))
+                    j += 2
+                else:
+                    new_board[r][c] = value
+                    self.last_moves.append((source, (r, c), value, False))
+                    j += 1
+                target += 1
+        self.board = new_board
+
+    def undo(self):
+        step = self.history.undo() if self.history is not None else None
+        if step is None:
+            return False
+        packed, delta = step
+        self.board = unpack_board(packed, self.grid_size)
+        self.score -= delta
+        self.assisted = True
+        return True
+
+    def redo(self):
+        step = self.history.redo() if self.history is not None else None
+        if step is None:
+            return False
+        packed, delta = step
+        self.board = unpack_board(packed, self.grid_size)
+        self.score += delta
+        return True
+
+    def max_tile(self):
+        return max(max(row) for row in self.board)
+
+    def to_replay(self):
+        return Replay(self.grid_size, self.seed, self.moves, self.score, self.max_tile(), self.spawn)
+
+    def snapshot(self):
+        # независимая копия для потока автосохранения: только копирование буферов, без кодирования
+        board = Board.__new__(Board)
+        board.__dict__.update(self.__dict__)
+        board.board = [row[:] for row in self.board]
+        board.rng = random.Random()
+        board.rng.setstate(self.rng.getstate())
+        board.moves = bytes(self.moves)
+        board.last_moves = []
+        if self.history is not None:
+            board.history = self.history.copy()
+        return board
+
+    def to_bytes(self):
+        cells = bytes(value.bit_length() - 1 if value else 0 for row in self.board for value in row)
+        _, internal_state, gauss_next = self.rng.getstate()
+        rng_state = RNG_STATE.pack(*internal_state, gauss_next is not None, gauss_next or 0.0)
+        # с версии 3 признак отмены хранится в заголовке: истории может не быть, а признак остаётся
+        header = (SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, self.grid_size, self.score) +
+                  SAVE_FLAGS.pack(self.assisted))
+        data = header + cells + rng_state + Replay(self.grid_size, self.seed, self.moves, spawn=self.spawn).to_bytes()
+        if self.history is not None:
+            data += self.history.to_bytes(self.assisted)
+        return data
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, grid_size, score = SAVE_HEADER.unpack_from(data)
+        if magic != SAVE_MAGIC or version not in (1, 2, SAVE_VERSION):
+            raise ValueError("not a 2048 save file")
+        offset = SAVE_HEADER.size
+        assisted = False
+        if version >= 3:
+            assisted, = SAVE_FLAGS.unpack_from(data, offset)
+            offset += SAVE_FLAGS.size
+        cells = data[offset:offset + grid_size * grid_size]
+        offset += grid_size * grid_size
+        *internal_state, has_gauss, gauss_next = RNG_STATE.unpack_from(data, offset)
+        offset += RNG_STATE.size
+        replay = Replay.from_bytes(data[offset:])
+        board = cls.__new__(cls)
+        board.grid_size = grid_size
+        board.seed = replay.seed
+        board.spawn = replay.spawn
+        board.rng = random.Random()
+        board.rng.setstate((3, tuple(internal_state), gauss_next if has_gauss else None))
+        board.score = score
+        board.moves = bytearray(replay.moves)
+        board.board = [[1 << e if e else 0 for e in cells[r * grid_size:(r + 1) * grid_size]]
+                       for r in range(grid_size)]
+        board.history = None
+        board.assisted = assisted
+        board.track_moves = False
+        board.last_moves = []
+        board.last_spawn = None
+        offset += replay.size
+        if offset < len(data):
+            board.history, history_assisted = UndoHistory.from_bytes(data[offset:], grid_size)
+            board.assisted = assisted or history_assisted
+        return board
 
     def compress_and_merge(self, line):
         new_line = [num for num in line if num != 0]
@@ -151,6 +770,7 @@ class Board:
         self.board = self._transpose(self.board)
 
     def is_game_over(self):
+        GAME_OVER_CHECKS_TOTAL.inc()
 
         if any(0 in row for row in self.board):
             return False
@@ -174,32 +794,1427 @@ class Board:
         return [list(row) for row in zip(*board)]
 
 
+class PackedEngine:
+    _engines = {}
+
+    def __init__(self, grid_size=GRID_SIZE):
+        if grid_size > 4:
+            raise ValueError("packed engine supports boards up to 4x4")
+        self.grid_size = grid_size
+        self.cells = grid_size * grid_size
+        self.row_bits = 4 * grid_size
+        self.row_mask = (1 << self.row_bits) - 1
+        row_count = 1 << self.row_bits
+        self.left = [0] * row_count
+        self.right = [0] * row_count
+        self.scores = [0] * row_count
+        self.row_empties = [()] * row_count
+        patterns = {}
+        for row in range(row_count):
+            line = [(row >> (4 * i)) & 15 for i in range(grid_size)]
+            empties = tuple(i for i, exponent in enumerate(line) if not exponent)
+            self.row_empties[row] = patterns.setdefault(empties, empties)
+            merged, score = self._merge_line(line)
+            self.left[row] = self._pack_line(merged)
+            self.scores[row] = score
+            self.right[self._pack_line(line[::-1])] = self._pack_line(merged[::-1])
+
+    @classmethod
+    def for_size(cls, grid_size):
+        engine = cls._engines.get(grid_size)
+        if engine is None:
+            engine = cls._engines[grid_size] = cls(grid_size)
+        return engine
+
+    def _merge_line(self, line):
+        tiles = [e for e in line if e]
+        merged = []
+        score = 0
+        i = 0
+        while i < len(tiles):
+            if i + 1 < len(tiles) and tiles[i] == tiles[i + 1] and tiles[i] < 15:
+                merged.append(tiles[i] + 1)
+                score += 1 << (tiles[i] + 1)
+                i += 2
+            else:
+                merged.append(tiles[i])
+                i += 1
+        return merged + [0] * (self.grid_size - len(merged)), score
+
+    def _pack_line(self, line):
+        packed = 0
+        for i, exponent in enumerate(line):
+            packed |= exponent << (4 * i)
+        return packed
+
+    def transpose(self, packed):
+        if self.grid_size == 4:
+            a = (packed & 0xF0F00F0FF0F00F0F) | ((packed & 0x0000F0F00000F0F0) << 12) | (
+                (packed & 0x0F0F00000F0F0000) >> 12)
+            return (a & 0xFF00FF0000FF00FF) | ((a & 0x00FF00FF00000000) >> 24) | ((a & 0x00000000FF00FF00) << 24)
+        n = self.grid_size
+        result = 0
+        for r in range(n):
+            for c in range(n):
+                result |= ((packed >> (4 * (r * n + c))) & 15) << (4 * (c * n + r))
+        return result
+
+    def _move_rows(self, packed, table):
+        result = 0
+        score = 0
+        for shift in range(0, self.row_bits * self.grid_size, self.row_bits):
+            row = (packed >> shift) & self.row_mask
+            result |= table[row] << shift
+            score += self.scores[row]
+        return result, score
+
+    def move(self, packed, direction):
+        if direction == 0:
+            return self._move_rows(packed, self.left)
+        if direction == 1:
+            return self._move_rows(packed, self.right)
+        moved, score = self._move_rows(self.transpose(packed), self.left if direction == 2 else self.right)
+        return self.transpose(moved), score
+
+    def empty_cells(self, packed):
+        return [i for i in range(self.cells) if not (packed >> (4 * i)) & 15]
+
+    def spawn(self, packed, rng, distribution=CLASSIC_SPAWN):
+        empty = self.empty_cells(packed)
+        if not empty:
+            return packed
+        cell = rng.choice(empty)
+        return packed | (distribution.sample(rng.random()) << (4 * cell))
+
+    def spawn_from(self, packed, stream, distribution=CLASSIC_SPAWN):
+        # k-я пустая клетка берётся из таблицы пустых позиций строки, без списка всех пустых клеток
+        empties = [self.row_empties[(packed >> shift) & self.row_mask]
+                   for shift in range(0, self.row_bits * self.grid_size, self.row_bits)]
+        total = sum(map(len, empties))
+        if not total:
+            return packed
+        target = int(stream.next() * total)
+        for r, row in enumerate(empties):
+            if target < len(row):
+                break
+            target -= len(row)
+        cell = r * self.grid_size + row[target]
+        return packed | (distribution.sample(stream.next()) << (4 * cell))
+
+    def afterstates(self, packed):
+        for direction in range(4):
+            moved, reward = self.move(packed, direction)
+            if moved != packed:
+                yield direction, moved, reward
+
+    def spawn_outcomes(self, packed, distribution=CLASSIC_SPAWN):
+        empty = self.empty_cells(packed)
+        if not empty:
+            return
+        share = 1.0 / len(empty)
+        outcomes = [(exponent, probability * share) for exponent, probability in distribution.outcomes]
+        for cell in empty:
+            shift = 4 * cell
+            for exponent, probability in outcomes:
+                yield packed | (exponent << shift), probability
+
+    def spawn_outcomes_into(self, packed, states, probabilities, distribution=CLASSIC_SPAWN):
+        # буферы выделяются вызывающим один раз: array("Q")/array("d") или numpy на cells * len(values);
+        # пустые клетки берутся из таблицы строк, исходы пишутся сразу в буферы без промежуточных кортежей
+        bits, mask, row_empties = self.row_bits, self.row_mask, self.row_empties
+        shifts = range(0, bits * self.grid_size, bits)
+        empty_count = 0
+        for shift in shifts:
+            empty_count += len(row_empties[(packed >> shift) & mask])
+        if not empty_count:
+            return 0
+        share = 1.0 / empty_count
+        count = 0
+        for shift in shifts:
+            for column in row_empties[(packed >> shift) & mask]:
+                cell_shift = shift + 4 * column
+                for exponent, probability in distribution.outcomes:
+                    states[count] = packed | (exponent << cell_shift)
+                    probabilities[count] = probability * share
+                    count += 1
+        return count
+
+    def spawn_outcome_arrays(self, packed, distribution=CLASSIC_SPAWN):
+        import numpy
+        empty = numpy.array(self.empty_cells(packed), dtype=numpy.uint64)
+        if not len(empty):
+            return numpy.empty(0, dtype=numpy.uint64), numpy.empty(0)
+        exponents = numpy.array(distribution.exponents, dtype=numpy.uint64)
+        states = numpy.uint64(packed) | (exponents[None, :] << (empty[:, None] * numpy.uint64(4)))
+        probabilities = numpy.tile(numpy.array(distribution.probabilities) * (1.0 / len(empty)), len(empty))
+        return states.ravel(), probabilities
+
+    def new_game(self, rng, distribution=CLASSIC_SPAWN):
+        return self.spawn(self.spawn(0, rng, distribution), rng, distribution)
+
+    def new_game_from(self, stream, distribution=CLASSIC_SPAWN):
+        return self.spawn_from(self.spawn_from(0, stream, distribution), stream, distribution)
+
+    def max_exponent(self, packed):
+        return max((packed >> (4 * i)) & 15 for i in range(self.cells))
+
+    def is_game_over(self, packed):
+        return all(self.move(packed, direction)[0] == packed for direction in range(4))
+
+
+def pack_moves(moves):
+    # четыре 2-битных хода в байт, сдвигами по всему журналу сразу вместо цикла по ходам
+    groups = -(-len(moves) // 4)
+    value = int.from_bytes(bytes(moves) + bytes(4 * groups - len(moves)), "little")
+    value = (value | value >> 6) & int.from_bytes(b"\x0f\x00" * 2 * groups, "little")
+    value = (value | value >> 12) & int.from_bytes(b"\xff\x00\x00\x00" * groups, "little")
+    return value.to_bytes(4 * groups, "little")[::4]
+
+
+def unpack_moves(packed, count):
+    groups = len(packed)
+    spread = bytearray(4 * groups)
+    spread[::4] = packed
+    value = int.from_bytes(spread, "little")
+    value = ((value & int.from_bytes(b"\x0f\x00\x00\x00" * groups, "little")) |
+             (value & int.from_bytes(b"\xf0\x00\x00\x00" * groups, "little")) << 12)
+    value = ((value & int.from_bytes(b"\x03\x00" * 2 * groups, "little")) |
+             (value & int.from_bytes(b"\x0c\x00" * 2 * groups, "little")) << 6)
+    return value.to_bytes(4 * groups, "little")[:count]
+
+
+class Replay:
+    def __init__(self, grid_size, seed, moves, score=0, max_tile=0, spawn=CLASSIC_SPAWN):
+        self.grid_size = grid_size
+        self.seed = seed
+        self.moves = bytes(moves)
+        self.score = score
+        self.max_tile = max_tile
+        self.spawn = spawn
+
+    @property
+    def size(self):
+        spawn_size = 0 if self.spawn.classic else 1 + len(self.spawn.values) * SPAWN_ENTRY.size
+        return REPLAY_HEADER.size + spawn_size + (len(self.moves) + 3) // 4
+
+    def to_bytes(self):
+        # версия 1 — классические 2/4, версия 2 хранит распределение после заголовка
+        version = REPLAY_VERSION if self.spawn.classic else REPLAY_SPAWN_VERSION
+        header = REPLAY_HEADER.pack(version, self.grid_size, self.seed, self.score, self.max_tile, len(self.moves))
+        if not self.spawn.classic:
+            header += self.spawn.to_bytes()
+        return header + pack_moves(self.moves)
+
+    @classmethod
+    def from_bytes(cls, buffer):
+        version, grid_size, seed, score, max_tile, move_count = REPLAY_HEADER.unpack_from(buffer)
+        offset = REPLAY_HEADER.size
+        if version == REPLAY_VERSION:
+            spawn = CLASSIC_SPAWN
+        elif version == REPLAY_SPAWN_VERSION:
+            spawn, spawn_size = SpawnDistribution.from_bytes(buffer, offset)
+            offset += spawn_size
+        else:
+            raise ValueError(f"unsupported replay version {version}")
+        moves = unpack_moves(buffer[offset:offset + (move_count + 3) // 4], move_count)
+        return cls(grid_size, seed, moves, score, max_tile, spawn)
+
+
+class ReplayArchive:
+    def __init__(self, path="replays.bin"):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = 0
+        for file_path in (self.path, self.index_path):
+            if not os.path.exists(file_path):
+                open(file_path, "wb").close()
+        self._check_index()
+
+    def _check_index(self):
+        index_size = os.path.getsize(self.index_path)
+        usable = index_size - index_size % ARCHIVE_INDEX_RECORD.size
+        data_size = os.path.getsize(self.path)
+        # Обрезаем хвост, оставшийся после аварийного завершения во время записи.
+        while usable:
+            with open(self.index_path, "rb") as index_file:
+                index_file.seek(usable - ARCHIVE_INDEX_RECORD.size)
+                offset, length = ARCHIVE_INDEX_RECORD.unpack(index_file.read(ARCHIVE_INDEX_RECORD.size))
+            if offset + length <= data_size:
+                break
+            usable -= ARCHIVE_INDEX_RECORD.size
+        if usable != index_size:
+            with open(self.index_path, "r+b") as index_file:
+                index_file.truncate(usable)
+
+    def __len__(self):
+        return os.path.getsize(self.index_path) // ARCHIVE_INDEX_RECORD.size
+
+    def append(self, replay):
+        data = replay.to_bytes()
+        with open(self.path, "ab") as data_file:
+            offset = data_file.tell()
+            data_file.write(data)
+        with open(self.index_path, "ab") as index_file:
+            index_file.write(ARCHIVE_INDEX_RECORD.pack(offset, len(data)))
+        return len(self) - 1
+
+    def _remap(self):
+        count = len(self)
+        if count == self._mapped_count:
+            return
+        self.close()
+        if count:
+            with open(self.path, "rb") as data_file:
+                self._data_map = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.index_path, "rb") as index_file:
+                self._index_map = mmap.mmap(index_file.fileno(), count * ARCHIVE_INDEX_RECORD.size,
+                                            access=mmap.ACCESS_READ)
+        self._mapped_count = count
+
+    def raw(self, number):
+        self._remap()
+        if not 0 <= number < self._mapped_count:
+            raise IndexError(number)
+        offset, length = ARCHIVE_INDEX_RECORD.unpack_from(self._index_map, number * ARCHIVE_INDEX_RECORD.size)
+        return memoryview(self._data_map)[offset:offset + length]
+
+    def get(self, number):
+        return Replay.from_bytes(self.raw(number))
+
+    def header(self, number):
+        return REPLAY_HEADER.unpack_from(self.raw(number))
+
+    def __iter__(self):
+        self._remap()
+        for number in range(self._mapped_count):
+            yield self.raw(number)
+
+    def filter(self, min_score=0, min_tile=0, grid_size=None):
+        self._remap()
+        for number in range(self._mapped_count):
+            offset = ARCHIVE_INDEX_RECORD.unpack_from(self._index_map, number * ARCHIVE_INDEX_RECORD.size)[0]
+            _, size, _, score, max_tile, _ = REPLAY_HEADER.unpack_from(self._data_map, offset)
+            if score >= min_score and max_tile >= min_tile and (grid_size is None or size == grid_size):
+                yield number
+
+    def close(self):
+        for mapped in (self._data_map, self._index_map):
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = 0
+
+
+def _replay_with_board(replay):
+    board = Board(replay.grid_size, replay.seed, spawn=replay.spawn)
+    for step, direction in enumerate(replay.moves):
+        if not board.move(direction):
+            return None, f"illegal move {MOVES[direction]} at step {step}"
+    return (board.score, board.max_tile()), None
+
+
+def _replay_with_engine(replay):
+    engine = PackedEngine.for_size(replay.grid_size)
+    rng = random.Random(replay.seed)
+    packed = engine.new_game(rng, replay.spawn)
+    score = 0
+    for step, direction in enumerate(replay.moves):
+        moved, gained = engine.move(packed, direction)
+        if moved == packed:
+            if engine.max_exponent(packed) >= 15:
+                return _replay_with_board(replay)
+            return None, f"illegal move {MOVES[direction]} at step {step}"
+        score += gained
+        packed = engine.spawn(moved, rng, replay.spawn)
+    exponent = engine.max_exponent(packed)
+    if exponent >= 15:
+        return _replay_with_board(replay)
+    return (score, 1 << exponent if exponent else 0), None
+
+
+def verify_replay(data):
+    try:
+        replay = Replay.from_bytes(data)
+    except (ValueError, IndexError, struct.error) as error:
+        return False, f"malformed replay: {error}", 0, 0
+    if not 2 <= replay.grid_size <= 8:
+        return False, f"unsupported board size {replay.grid_size}", 0, 0
+    if replay.grid_size <= 4 and max(replay.spawn.exponents) < 15:
+        result, reason = _replay_with_engine(replay)
+    else:
+        result, reason = _replay_with_board(replay)
+    if result is None:
+        return False, reason, 0, 0
+    score, max_tile = result
+    if score != replay.score:
+        return False, f"claimed score {replay.score}, replayed {score}", score, max_tile
+    if max_tile != replay.max_tile:
+        return False, f"claimed max tile {replay.max_tile}, replayed {max_tile}", score, max_tile
+    return True, "ok", score, max_tile
+
+
+def _init_verify_worker():
+    PackedEngine.for_size(GRID_SIZE)
+
+
+class ReplayVerifier:
+    def __init__(self, processes=None):
+        self.pool = multiprocessing.Pool(processes, initializer=_init_verify_worker)
+
+    def verify(self, data):
+        return self.pool.apply(verify_replay, (bytes(data),))
+
+    def verify_many(self, replays, chunksize=64):
+        return self.pool.imap(verify_replay, (bytes(data) for data in replays), chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class SubmissionHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            header = self.rfile.read(SUBMISSION_HEADER.size)
+            if len(header) < SUBMISSION_HEADER.size:
+                return
+            name_length, replay_length = SUBMISSION_HEADER.unpack(header)
+            name = self.rfile.read(name_length).decode("utf-8", "replace")
+            data = self.rfile.read(replay_length)
+            ok, reason, score, max_tile = self.server.verifier.verify(data)
+            if ok:
+                with self.server.db_lock:
+                    if not self.server.db_manager.add_leaderboard_entry(name, score, max_tile,
+                                                                        Replay.from_bytes(data)):
+                        ok, reason = False, "duplicate replay"
+            answer = f"OK {score} {max_tile}" if ok else f"REJECT {reason}"
+            self.wfile.write(answer.encode("utf-8") + b"\n")
+
+
+class SubmissionServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=VERIFY_PORT, processes=None, db_path="highscore.db"):
+        super().__init__(("127.0.0.1", port), SubmissionHandler)
+        self.verifier = ReplayVerifier(processes)
+        self.db_manager = DatabaseManager(db_path, check_same_thread=False)
+        self.db_lock = threading.Lock()
+
+    def server_close(self):
+        super().server_close()
+        self.verifier.close()
+        self.db_manager.close()
+
+
+def verify_command(paths, processes=None):
+    verifier = ReplayVerifier(processes)
+    db_manager = DatabaseManager()
+    accepted = rejected = 0
+    started = time.perf_counter()
+    for path in paths:
+        archive = ReplayArchive(path)
+        for number, result in enumerate(verifier.verify_many(archive)):
+            ok, reason, score, max_tile = result
+            if ok and db_manager.add_leaderboard_entry(os.path.basename(path), score, max_tile,
+                                                       archive.get(number)):
+                accepted += 1
+            else:
+                rejected += 1
+                print(f"{path}#{number}: {reason if not ok else 'duplicate replay'}")
+        archive.close()
+    elapsed = time.perf_counter() - started
+    total = accepted + rejected
+    print(f"verified {total} replays in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f}/s): "
+          f"{accepted} accepted, {rejected} rejected")
+    verifier.close()
+    db_manager.close()
+    return rejected == 0
+
+
+def write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_game(path=SAVE_PATH):
+    try:
+        with open(path, "rb") as save_file:
+            return Board.from_bytes(save_file.read())
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+class AutoSaver:
+    def __init__(self, path=SAVE_PATH, interval=AUTOSAVE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._pending = None
+        self._last_write = 0.0
+        self._closed = False
+        self._generation = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._worker, name="autosave", daemon=True)
+        self._thread.start()
+
+    def submit(self, board):
+        # на кадре только снимок, кодирование и запись — в потоке автосохранения
+        snapshot = board.snapshot()
+        with self._condition:
+            self._pending = snapshot
+            self._condition.notify()
+
+    def discard(self):
+        # пустой снимок — удаление файла; его выполняет поток автосохранения без ожидания интервала
+        with self._condition:
+            self._pending = b""
+            self._generation += 1
+            self._condition.notify()
+
+    def has_save(self):
+        with self._condition:
+            if self._pending == b"":
+                return False
+        return os.path.exists(self.path)
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                delay = self._last_write + self.interval - time.monotonic()
+                if delay > 0 and self._pending != b"" and not self._closed:
+                    self._condition.wait(delay)
+                    continue
+                snapshot, self._pending = self._pending, None
+                generation = self._generation
+            self._write(snapshot, generation)
+
+    def _write(self, snapshot, generation):
+        try:
+            if not snapshot:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            # снимок, взятый до discard, уже устарел и не должен вернуть файл
+            if generation == self._generation:
+                write_atomic(self.path, snapshot.to_bytes())
+        except OSError:
+            pass
+        self._last_write = time.monotonic()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+def npy_header(dtype, shape):
+    description = f"{{'descr': '{dtype}', 'fortran_order': False, 'shape': {shape!r}, }}"
+    padding = NPY_HEADER_SIZE - 10 - len(description) - 1
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", NPY_HEADER_SIZE - 10) + (
+            description + " " * padding + "\n").encode("latin1")
+
+
+class TrajectoryWriter:
+    def __init__(self, directory, grid_size=GRID_SIZE, shard_size=SHARD_SIZE):
+        self.directory = directory
+        self.grid_size = grid_size
+        self.cells = grid_size * grid_size
+        self.shard_size = shard_size
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        os.makedirs(directory, exist_ok=True)
+        self.shards = []
+        self.total_steps = 0
+        self._columns = None
+        self._position = 0
+        self._pairs = [bytes((byte & 15, byte >> 4)) for byte in range(256)]
+
+    def _item_shape(self, name):
+        return (self.cells,) if name == "states" else ()
+
+    def _open_shard(self):
+        self._columns = {}
+        for name, dtype, code in TRAJECTORY_COLUMNS:
+            path = os.path.join(self.directory, f"{name}-{len(self.shards):05d}.npy")
+            row_size = struct.calcsize(code) * (self.cells if name == "states" else 1)
+            with open(path, "wb") as column_file:
+                column_file.write(npy_header(dtype, (self.shard_size,) + self._item_shape(name)))
+                column_file.truncate(NPY_HEADER_SIZE + row_size * self.shard_size)
+            with open(path, "r+b") as column_file:
+                mapped = mmap.mmap(column_file.fileno(), 0)
+            self._columns[name] = (path, mapped, memoryview(mapped)[NPY_HEADER_SIZE:].cast(code))
+        self._position = 0
+
+    def append(self, packed, action, reward, done):
+        if self._columns is None:
+            self._open_shard()
+        position = self._position
+        state = b"".join(self._pairs[byte] for byte in packed.to_bytes((self.cells + 1) // 2, "little"))
+        states = self._columns["states"][2]
+        states[position * self.cells:(position + 1) * self.cells] = state[:self.cells]
+        self._columns["actions"][2][position] = action
+        self._columns["rewards"][2][position] = reward
+        self._columns["dones"][2][position] = done
+        self._position += 1
+        if self._position == self.shard_size:
+            self._close_shard()
+
+    def _close_shard(self):
+        files = {}
+        for name, dtype, _ in TRAJECTORY_COLUMNS:
+            path, mapped, view = self._columns[name]
+            row_size = view.itemsize * (self.cells if name == "states" else 1)
+            mapped[:NPY_HEADER_SIZE] = npy_header(dtype, (self._position,) + self._item_shape(name))
+            view.release()
+            mapped.flush()
+            mapped.close()
+            if self._position < self.shard_size:
+                with open(path, "r+b") as column_file:
+                    column_file.truncate(NPY_HEADER_SIZE + row_size * self._position)
+            files[name] = os.path.basename(path)
+        self.shards.append({"steps": self._position, "files": files})
+        self.total_steps += self._position
+        self._columns = None
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {
+            "grid_size": self.grid_size,
+            "columns": {name: dtype for name, dtype, _ in TRAJECTORY_COLUMNS},
+            "shard_size": self.shard_size,
+            "total_steps": self.total_steps,
+            "shards": self.shards,
+        }
+        write_atomic(self.manifest_path, json.dumps(manifest, indent=1).encode("utf-8"))
+
+    def add_game(self, engine, stream, policy, distribution=CLASSIC_SPAWN):
+        packed = engine.new_game_from(stream, distribution)
+        while True:
+            direction = policy(engine, packed, stream.rng)
+            if direction is None:
+                return
+            moved, reward = engine.move(packed, direction)
+            packed_next = engine.spawn_from(moved, stream, distribution)
+            done = engine.is_game_over(packed_next)
+            self.append(packed, direction, reward, done)
+            if done:
+                return
+            packed = packed_next
+
+    def add_replay(self, replay):
+        engine = PackedEngine.for_size(replay.grid_size)
+        rng = random.Random(replay.seed)
+        packed = engine.new_game(rng, replay.spawn)
+        for step, direction in enumerate(replay.moves):
+            moved, reward = engine.move(packed, direction)
+            self.append(packed, direction, reward, step == len(replay.moves) - 1)
+            packed = engine.spawn(moved, rng, replay.spawn)
+
+    def close(self):
+        if self._columns is not None and self._position:
+            self._close_shard()
+        elif self._columns is not None:
+            for path, mapped, view in self._columns.values():
+                view.release()
+                mapped.close()
+                os.remove(path)
+            self._columns = None
+        if not os.path.exists(self.manifest_path):
+            self._write_manifest()
+
+
+def random_policy(engine, packed, rng):
+    legal = [direction for direction in range(4) if engine.move(packed, direction)[0] != packed]
+    return rng.choice(legal) if legal else None
+
+
+def greedy_policy(engine, packed, rng):
+    best, best_value = None, None
+    for direction in range(4):
+        moved, reward = engine.move(packed, direction)
+        if moved == packed:
+            continue
+        # очки за ход плюс свободные клетки, ничьи разбиваются случайно
+        value = (reward + 4 * len(engine.empty_cells(moved)), rng.random())
+        if best_value is None or value > best_value:
+            best, best_value = direction, value
+    return best
+
+
+class Heuristic:
+    _features = {}
+
+    def __init__(self, engine, weights=None):
+        self.engine = engine
+        self.weights = dict(HEURISTIC_WEIGHTS, **(weights or {}))
+        features = Heuristic._features.get(engine.grid_size)
+        if features is None:
+            rows = [self._row_features(row) for row in range(1 << engine.row_bits)]
+            features = Heuristic._features[engine.grid_size] = tuple(zip(*rows))
+        # оценка строки линейна по весам, поэтому таблица для новых весов собирается из готовых признаков
+        lost, empty, merges, monotonicity, total = (self.weights[name] for name in
+                                                    ("lost", "empty", "merges", "monotonicity", "sum"))
+        self.table = [lost + empty * e + merges * m - monotonicity * mono - total * t
+                      for e, m, mono, t in zip(*features)]
+
+    def _row_features(self, row):
+        line = [(row >> (4 * i)) & 15 for i in range(self.engine.grid_size)]
+        merges = 0
+        previous = 0
+        streak = 0
+        for exponent in line:
+            if not exponent:
+                continue
+            if exponent == previous:
+                streak += 1
+            elif streak:
+                merges += 1 + streak
+                streak = 0
+            previous = exponent
+        if streak:
+            merges += 1 + streak
+        decreasing = increasing = 0
+        for left, right in zip(line, line[1:]):
+            if left > right:
+                decreasing += left ** 4 - right ** 4
+            else:
+                increasing += right ** 4 - left ** 4
+        return line.count(0), merges, min(decreasing, increasing), sum(exponent ** 3.5 for exponent in line)
+
+    def evaluate(self, packed):
+        engine, table = self.engine, self.table
+        mask, bits = engine.row_mask, engine.row_bits
+        columns = engine.transpose(packed)
+        shifts = range(0, bits * engine.grid_size, bits)
+        # fsum не зависит от порядка слагаемых, поэтому симметричные доски дают побитово равные оценки
+        return math.fsum(chain([table[(packed >> shift) & mask] for shift in shifts],
+                               [table[(columns >> shift) & mask] for shift in shifts]))
+
+
+class TranspositionTable:
+    # Общая для процессов таблица без блокировок: слот — три слова (проверка, значение, мета),
+    # мета = глубина | порог вероятности (float32) << 32, проверка = ключ ^ значение ^ мета.
+    # Писатель кладёт проверку последней, читатель сверяет её,
+    # поэтому разорванная или перезаписанная соседом запись просто считается промахом.
+    def __init__(self, path, engine, fingerprint, slots=TT_SLOTS, readonly=False):
+        if slots & (slots - 1):
+            raise ValueError("number of slots must be a power of two")
+        if not os.path.exists(path):
+            self._create(path, engine.grid_size, fingerprint, slots)
+        self.path = path
+        self.engine = engine
+        self.symmetries = Symmetries.for_engine(engine)
+        self.readonly = readonly
+        self._file = open(path, "rb" if readonly else "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        magic, version, grid_size, self.slots, stored = TT_HEADER.unpack_from(self._map)
+        if magic != TT_MAGIC or version != TT_VERSION:
+            raise ValueError("not a transposition table file")
+        if grid_size != engine.grid_size or stored != fingerprint:
+            raise ValueError("transposition table was built with other search settings")
+        self._words = memoryview(self._map)[TT_HEADER.size:].cast("Q")
+        self._shift = 64 - (self.slots.bit_length() - 1)
+        self.hits = self.misses = self.stores = 0
+
+    @staticmethod
+    def _create(path, grid_size, fingerprint, slots):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(TT_HEADER.pack(TT_MAGIC, TT_VERSION, grid_size, slots, fingerprint))
+            tmp_file.truncate(TT_HEADER.size + TT_ENTRY.size * slots)
+        try:
+            # link не перезаписывает: если файл успел создать другой процесс, берём его
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    def canonical(self, packed):
+        return self.symmetries.canonical(packed)[0]
+
+    def _slot(self, key):
+        return 3 * (((key * TT_HASH) & 0xFFFFFFFFFFFFFFFF) >> self._shift)
+
+    def get(self, key, depth, probability):
+        words = self._words
+        base = self._slot(key)
+        check, bits, meta = words[base], words[base + 1], words[base + 2]
+        if meta & 0xFF == depth and check == key ^ bits ^ meta:
+            bound = struct.unpack("<f", struct.pack("<I", meta >> 32))[0]
+            if probability >= bound:
+                self.hits += 1
+                return struct.unpack("<d", struct.pack("<Q", bits))[0], bound
+        self.misses += 1
+        return None
+
+    def put(self, key, depth, value, bound):
+        if self.readonly:
+            return
+        words = self._words
+        base = self._slot(key)
+        meta = words[base + 2]
+        # более глубокий результат для той же позиции не затираем
+        if meta & 0xFF > depth and words[base] == key ^ words[base + 1] ^ meta:
+            return
+        bound_bits = struct.unpack("<I", struct.pack("<f", bound))[0]
+        if struct.unpack("<f", struct.pack("<I", bound_bits))[0] < bound:
+            # округление до float32 не должно опускать порог ниже настоящего
+            bound_bits += 1
+        bits = struct.unpack("<Q", struct.pack("<d", value))[0]
+        meta = depth | bound_bits << 32
+        words[base] = 0
+        words[base + 1] = bits
+        words[base + 2] = meta
+        words[base] = key ^ bits ^ meta
+        self.stores += 1
+
+    def __len__(self):
+        words = self._words
+        return sum(1 for base in range(0, 3 * self.slots, 3)
+                   if words[base + 2] and words[base] ^ words[base + 1] ^ words[base + 2])
+
+    def close(self):
+        self._words.release()
+        if not self.readonly:
+            self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+class Expectimax:
+    def __init__(self, engine, heuristic=None, depth=2, distribution=CLASSIC_SPAWN, min_probability=1e-4,
+                 tablebase=None, table=None):
+        self.engine = engine
+        self.tablebase = tablebase
+        self.table = table
+        self.heuristic = heuristic or Heuristic(engine)
+        self.depth = depth
+        self.distribution = distribution
+        self.min_probability = min_probability
+        self.cache = {}
+
+    def fingerprint(self):
+        # значения в общей таблице годятся только для тех же весов, распределения и порога
+        settings = repr((self.engine.grid_size, sorted(self.heuristic.weights.items()),
+                         self.distribution.to_bytes(), self.min_probability))
+        return int.from_bytes(hashlib.sha1(settings.encode("utf-8")).digest()[:8], "little")
+
+    def __call__(self, engine, packed, rng):
+        return self.best_move(packed)
+
+    def best_move(self, packed):
+        if self.tablebase is not None:
+            entry = self.tablebase.lookup(packed)
+            if entry is not None and entry[2] is not None:
+                return entry[2]
+        self.cache = {}
+        best, best_value = None, None
+        for direction, moved, _ in self.engine.afterstates(packed):
+            value = self._chance(moved, self.depth, 1.0)[0]
+            if best_value is None or value > best_value:
+                best, best_value = direction, value
+        return best
+
+    # Возвращает (значение, порог): порог — наименьшая вероятность достижения узла, при которой
+    # в его поддереве нет отсечения по min_probability. Кэшируются только значения без отсечений,
+    # и берутся из кэша только там, где свежий поиск тоже не отсёк бы ничего.
+    def _chance(self, packed, depth, probability):
+        if depth == 0:
+            return self.heuristic.evaluate(packed), 0.0
+        if probability < self.min_probability:
+            return self.heuristic.evaluate(packed), math.inf
+        key = (packed, depth)
+        entry = self.cache.get(key)
+        if entry is not None and probability >= entry[1]:
+            return entry
+        table = self.table
+        if table is not None:
+            canonical = table.canonical(packed)
+            entry = table.get(canonical, depth, probability)
+            if entry is not None:
+                return entry
+        terms, bound = [], self.min_probability
+        for state, outcome_probability in self.engine.spawn_outcomes(packed, self.distribution):
+            child_value, child_bound = self._max(state, depth, probability * outcome_probability)
+            terms.append(outcome_probability * child_value)
+            bound = max(bound, child_bound / outcome_probability)
+        value = math.fsum(terms)
+        if probability >= bound:
+            self.cache[key] = value, bound
+            if table is not None:
+                table.put(canonical, depth, value, bound)
+        return value, bound
+
+    def _max(self, packed, depth, probability):
+        # нет ходов — проигрыш, он хуже любой живой позиции
+        best, bound = None, 0.0
+        for _, moved, _ in self.engine.afterstates(packed):
+            value, child_bound = self._chance(moved, depth - 1, probability)
+            if best is None or value > best:
+                best = value
+            bound = max(bound, child_bound)
+        return best or 0.0, bound
+
+
+def load_trajectories(directory):
+    import numpy
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    for shard in manifest["shards"]:
+        yield {name: numpy.load(os.path.join(directory, file_name), mmap_mode="r")
+               for name, file_name in shard["files"].items()}
+
+
+def make_policy(name, engine, spawn=CLASSIC_SPAWN, table_path=None, table_slots=TT_SLOTS):
+    if name == "expectimax":
+        search = Expectimax(engine, distribution=spawn)
+        if table_path:
+            search.table = TranspositionTable(table_path, engine, search.fingerprint(), table_slots)
+        return search
+    return {"random": random_policy, "greedy": greedy_policy}[name]
+
+
+def opening_positions(engine, plies, distribution=CLASSIC_SPAWN):
+    symmetries = Symmetries.for_engine(engine)
+    layer = {symmetries.canonical(state)[0]
+             for first, _ in engine.spawn_outcomes(0, distribution)
+             for state, _ in engine.spawn_outcomes(first, distribution)}
+    for ply in range(plies):
+        yield ply, sorted(layer)
+        if ply + 1 < plies:
+            layer = {symmetries.canonical(state)[0] for packed in layer for _, moved, _ in engine.afterstates(packed)
+                     for state, _ in engine.spawn_outcomes(moved, distribution)}
+
+
+_opening_search = None
+
+
+def _init_opening_worker(path, grid_size, spawn, slots):
+    global _opening_search
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    engine = PackedEngine.for_size(grid_size)
+    _opening_search = make_policy("expectimax", engine, spawn, path, slots)
+
+
+def _search_openings(states):
+    table = _opening_search.table
+    hits, misses = table.hits, table.misses
+    for packed in states:
+        _opening_search.best_move(packed)
+    return table.hits - hits, table.misses - misses
+
+
+def precompute_command(path, plies, slots=TT_SLOTS, processes=None, grid_size=GRID_SIZE, spawn=CLASSIC_SPAWN):
+    engine = PackedEngine.for_size(grid_size)
+    # файл создаётся заранее, чтобы рабочие не спорили о размере таблицы
+    make_policy("expectimax", engine, spawn, path, slots).table.close()
+    pool = multiprocessing.Pool(processes, initializer=_init_opening_worker, initargs=(path, grid_size, spawn, slots))
+    started = time.perf_counter()
+    try:
+        for ply, states in opening_positions(engine, plies, spawn):
+            chunks = [states[i:i + 16] for i in range(0, len(states), 16)]
+            hits = misses = 0
+            for chunk_hits, chunk_misses in pool.imap_unordered(_search_openings, chunks):
+                hits += chunk_hits
+                misses += chunk_misses
+            print(f"ply {ply}: {len(states)} positions, table hit rate {hits / max(hits + misses, 1):.1%}, "
+                  f"{time.perf_counter() - started:.1f}s")
+    finally:
+        pool.close()
+        pool.join()
+    print(f"transposition table -> {path}")
+
+
+_tuning_settings = None
+
+
+def _init_tuning_worker(grid_size, spawn, depth):
+    global _tuning_settings
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _tuning_settings = PackedEngine.for_size(grid_size), spawn, depth
+
+
+def _play_tuning_games(task):
+    candidate, weights, seeds = task
+    engine, spawn, depth = _tuning_settings
+    search = Expectimax(engine, Heuristic(engine, weights), depth, spawn)
+    score = moves = 0
+    for seed in seeds:
+        stream = SpawnStream(seed)
+        packed = engine.new_game_from(stream, spawn)
+        while True:
+            direction = search.best_move(packed)
+            if direction is None:
+                break
+            packed, reward = engine.move(packed, direction)
+            packed = engine.spawn_from(packed, stream, spawn)
+            score += reward
+            moves += 1
+    return candidate, score, moves
+
+
+class WeightTuner:
+    # метод перекрёстной энтропии в логарифмах весов: веса положительны и отличаются на порядки
+    def __init__(self, population=TUNE_POPULATION, games=TUNE_GAMES, elite=TUNE_ELITE, processes=None,
+                 checkpoint_path=TUNE_CHECKPOINT, grid_size=GRID_SIZE, spawn=CLASSIC_SPAWN, depth=0):
+        self.population = population
+        self.games = games
+        self.elite = max(2, int(population * elite))
+        self.checkpoint_path = checkpoint_path
+        self.generation = 0
+        self.mean = {name: math.log(HEURISTIC_WEIGHTS[name]) for name in TUNE_WEIGHTS}
+        self.sigma = {name: TUNE_SIGMA for name in TUNE_WEIGHTS}
+        self.best_weights, self.best_score = None, None
+        self.history = []
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self._load_checkpoint()
+        self.pool = multiprocessing.Pool(processes, initializer=_init_tuning_worker,
+                                         initargs=(grid_size, spawn, depth))
+
+    def _load_checkpoint(self):
+        with open(self.checkpoint_path, encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.generation = checkpoint["generation"]
+        self.mean = {name: math.log(value) for name, value in checkpoint["mean"].items()}
+        self.sigma = checkpoint["sigma"]
+        self.best_weights, self.best_score = checkpoint["best_weights"], checkpoint["best_score"]
+        self.history = checkpoint["history"]
+
+    def _save_checkpoint(self):
+        checkpoint = {"generation": self.generation,
+                      "mean": {name: math.exp(value) for name, value in self.mean.items()},
+                      "sigma": self.sigma, "best_weights": self.best_weights, "best_score": self.best_score,
+                      "history": self.history}
+        write_atomic(self.checkpoint_path, json.dumps(checkpoint, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    def step(self):
+        rng = random.Random(self.generation)
+        candidates = [{name: math.exp(rng.gauss(self.mean[name], self.sigma[name])) for name in TUNE_WEIGHTS}
+                      for _ in range(self.population)]
+        # общие случайные числа: все кандидаты поколения играют на одних и тех же зёрнах
+        seeds = range(self.generation * self.games, (self.generation + 1) * self.games)
+        tasks = [(candidate, weights, seeds[i:i + TUNE_CHUNK]) for candidate, weights in enumerate(candidates)
+                 for i in range(0, self.games, TUNE_CHUNK)]
+        scores = [0] * self.population
+        total_moves = 0
+        started = time.perf_counter()
+        for candidate, score, moves in self.pool.imap_unordered(_play_tuning_games, tasks):
+            scores[candidate] += score
+            total_moves += moves
+        elapsed = time.perf_counter() - started
+        ranked = sorted(range(self.population), key=scores.__getitem__, reverse=True)[:self.elite]
+        for name in TUNE_WEIGHTS:
+            logs = [math.log(candidates[candidate][name]) for candidate in ranked]
+            self.mean[name] = sum(logs) / len(logs)
+            variance = sum((value - self.mean[name]) ** 2 for value in logs) / len(logs)
+            self.sigma[name] = max(math.sqrt(variance), TUNE_MIN_SIGMA)
+        best_score = scores[ranked[0]] / self.games
+        if self.best_score is None or best_score > self.best_score:
+            self.best_weights, self.best_score = candidates[ranked[0]], best_score
+        games = self.population * self.games
+        result = {"generation": self.generation, "best_score": best_score,
+                  "elite_score": sum(scores[candidate] for candidate in ranked) / (self.elite * self.games),
+                  "games_per_second": games / elapsed, "moves_per_second": total_moves / elapsed}
+        self.history.append(result)
+        self.generation += 1
+        if self.checkpoint_path:
+            self._save_checkpoint()
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def tune_command(generations, population=TUNE_POPULATION, games=TUNE_GAMES, processes=None,
+                 checkpoint_path=TUNE_CHECKPOINT, spawn=CLASSIC_SPAWN, depth=0):
+    tuner = WeightTuner(population, games, processes=processes, checkpoint_path=checkpoint_path, spawn=spawn,
+                        depth=depth)
+    try:
+        while tuner.generation < generations:
+            result = tuner.step()
+            print(f"generation {result['generation']}: best {result['best_score']:.0f}, "
+                  f"elite {result['elite_score']:.0f}, {result['games_per_second']:.1f} games/s, "
+                  f"{result['moves_per_second']:.0f} moves/s")
+    finally:
+        tuner.close()
+    print(f"best {tuner.best_score:.0f}: {json.dumps(tuner.best_weights)}")
+
+
+def export_command(directory, archives, games, shard_size, grid_size=GRID_SIZE, spawn=CLASSIC_SPAWN,
+                   policy_name="random", table_path=None):
+    writer = TrajectoryWriter(directory, grid_size, shard_size)
+    started = time.perf_counter()
+    for path in archives:
+        archive = ReplayArchive(path)
+        for number in archive.filter(grid_size=grid_size):
+            writer.add_replay(archive.get(number))
+        archive.close()
+    engine = PackedEngine.for_size(grid_size)
+    policy = make_policy(policy_name, engine, spawn, table_path)
+    for seed in range(games):
+        writer.add_game(engine, SpawnStream(seed), policy, spawn)
+    writer.close()
+    if getattr(policy, "table", None) is not None:
+        policy.table.close()
+    elapsed = time.perf_counter() - started
+    print(f"exported {writer.total_steps} steps into {len(writer.shards)} shards in {elapsed:.2f}s")
+
+
+class Symmetries:
+    _cache = {}
+    # перестановки направлений (влево, вправо, вверх, вниз) при транспонировании и отражениях
+    TRANSPOSE_MOVES = (2, 3, 0, 1)
+    MIRROR_COLUMNS_MOVES = (1, 0, 2, 3)
+    MIRROR_ROWS_MOVES = (0, 1, 3, 2)
+
+    def __init__(self, engine):
+        n = engine.grid_size
+        self.engine = engine
+        self.reverse = [0] * (1 << engine.row_bits)
+        self.spread = [0] * (1 << engine.row_bits)
+        for row in range(1 << engine.row_bits):
+            for c in range(n):
+                nibble = (row >> (4 * c)) & 15
+                self.reverse[row] |= nibble << (4 * (n - 1 - c))
+                self.spread[row] |= nibble << (4 * c * n)
+        self.moves = []
+        for index in range(8):
+            moves = list(range(4))
+            if index & 4:
+                moves = [self.TRANSPOSE_MOVES[d] for d in moves]
+            if index & 2:
+                moves = [self.MIRROR_COLUMNS_MOVES[d] for d in moves]
+            if index & 1:
+                moves = [self.MIRROR_ROWS_MOVES[d] for d in moves]
+            self.moves.append(tuple(moves))
+        self.inverse_moves = [tuple(moves.index(d) for d in range(4)) for moves in self.moves]
+
+    @classmethod
+    def for_engine(cls, engine):
+        symmetries = cls._cache.get(engine.grid_size)
+        if symmetries is None:
+            symmetries = cls._cache[engine.grid_size] = cls(engine)
+        return symmetries
+
+    def _rows(self, packed):
+        engine = self.engine
+        return [(packed >> shift) & engine.row_mask for shift in range(0, engine.row_bits * engine.grid_size,
+                                                                       engine.row_bits)]
+
+    def variants(self, packed):
+        engine = self.engine
+        bits = engine.row_bits
+        rows = self._rows(packed)
+        transposed = self._rows(sum(self.spread[row] << (4 * r) for r, row in enumerate(rows)))
+        for base in (rows, transposed):
+            for mirrored in (base, [self.reverse[row] for row in base]):
+                yield sum(row << (bits * r) for r, row in enumerate(mirrored))
+                yield sum(row << (bits * r) for r, row in enumerate(reversed(mirrored)))
+
+    def canonical(self, packed):
+        best, best_index = None, 0
+        for index, variant in enumerate(self.variants(packed)):
+            if best is None or variant < best:
+                best, best_index = variant, index
+        return best, best_index
+
+
+def solve_tablebase(grid_size, path, win_tile, distribution=CLASSIC_SPAWN):
+    engine = PackedEngine.for_size(grid_size)
+    symmetries = Symmetries.for_engine(engine)
+    win_exponent = win_tile.bit_length() - 1
+    spawn_values = {exponent: 1 << exponent for exponent in distribution.exponents}
+    # сумма плиток растёт с каждым появлением плитки, поэтому слои по сумме образуют ациклический граф
+    layers = {}
+    for first, _ in engine.spawn_outcomes(0, distribution):
+        for state, _ in engine.spawn_outcomes(first, distribution):
+            total = sum(1 << ((state >> (4 * i)) & 15) for i in range(engine.cells) if (state >> (4 * i)) & 15)
+            layers.setdefault(total, set()).add(symmetries.canonical(state)[0])
+    order = []
+    while layers:
+        total = min(layers)
+        layer = layers.pop(total)
+        order.append((total, layer))
+        for state in layer:
+            if engine.max_exponent(state) >= win_exponent:
+                continue
+            for _, moved, _ in engine.afterstates(state):
+                for cell in engine.empty_cells(moved):
+                    for exponent, value in spawn_values.items():
+                        child = symmetries.canonical(moved | (exponent << (4 * cell)))[0]
+                        layers.setdefault(total + value, set()).add(child)
+    expected, win, best = {}, {}, {}
+    for total, layer in reversed(order):
+        for state in layer:
+            if engine.max_exponent(state) >= win_exponent:
+                expected[state], win[state], best[state] = 0.0, 1.0, 0xFF
+                continue
+            best_score, best_win = None, None
+            score_move = win_move = 0xF
+            for direction, moved, reward in engine.afterstates(state):
+                score, chance = float(reward), 0.0
+                for child, probability in engine.spawn_outcomes(moved, distribution):
+                    child = symmetries.canonical(child)[0]
+                    score += probability * expected[child]
+                    chance += probability * win[child]
+                if best_score is None or score > best_score:
+                    best_score, score_move = score, direction
+                if best_win is None or chance > best_win:
+                    best_win, win_move = chance, direction
+            expected[state] = best_score or 0.0
+            win[state] = best_win or 0.0
+            best[state] = score_move | (win_move << 4)
+    keys = sorted(expected)
+    dense = (1 << (4 * engine.cells)) <= TABLEBASE_DENSE_LIMIT
+    count = 1 << (4 * engine.cells) if dense else len(keys)
+    expected_values = array("d", [-1.0]) * count
+    win_values = array("d", [-1.0]) * count
+    best_moves = bytearray(b"\xff") * count
+    for position, state in enumerate(keys):
+        index = state if dense else position
+        expected_values[index] = expected[state]
+        win_values[index] = win[state]
+        best_moves[index] = best[state]
+    header = TABLEBASE_HEADER.pack(TABLEBASE_MAGIC, 1, grid_size, win_exponent, dense, count)
+    body = (b"" if dense else array("Q", keys).tobytes()) + expected_values.tobytes() + win_values.tobytes()
+    write_atomic(path, header + body + bytes(best_moves))
+    return len(keys)
+
+
+class Tablebase:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, self.grid_size, win_exponent, self.dense, self.count = TABLEBASE_HEADER.unpack_from(self._map)
+        if magic != TABLEBASE_MAGIC:
+            raise ValueError("not a tablebase file")
+        self.win_tile = 1 << win_exponent
+        self.engine = PackedEngine.for_size(self.grid_size)
+        self.symmetries = Symmetries.for_engine(self.engine)
+        view = memoryview(self._map)
+        offset = TABLEBASE_HEADER.size
+        self.keys = None
+        if not self.dense:
+            self.keys = view[offset:offset + 8 * self.count].cast("Q")
+            offset += 8 * self.count
+        self.expected = view[offset:offset + 8 * self.count].cast("d")
+        offset += 8 * self.count
+        self.win = view[offset:offset + 8 * self.count].cast("d")
+        offset += 8 * self.count
+        self.best = view[offset:offset + self.count]
+
+    def __len__(self):
+        return self.count
+
+    def _index(self, canonical):
+        if self.dense:
+            return canonical if self.expected[canonical] >= 0 else None
+        index = bisect.bisect_left(self.keys, canonical)
+        return index if index < self.count and self.keys[index] == canonical else None
+
+    def lookup(self, packed):
+        canonical, variant = self.symmetries.canonical(packed)
+        index = self._index(canonical)
+        if index is None:
+            return None
+        best = self.best[index]
+        inverse = self.symmetries.inverse_moves[variant]
+        score_move = inverse[best & 15] if best & 15 < 4 else None
+        win_move = inverse[best >> 4] if best >> 4 < 4 else None
+        return self.expected[index], self.win[index], score_move, win_move
+
+    def close(self):
+        if self.keys is not None:
+            self.keys.release()
+        self.expected.release()
+        self.win.release()
+        self.best.release()
+        self._map.close()
+        self._file.close()
+
+
+def tablebase_command(grid_size, path, win_tile):
+    started = time.perf_counter()
+    count = solve_tablebase(grid_size, path, win_tile)
+    print(f"solved {count} canonical {grid_size}x{grid_size} states up to {win_tile} in "
+          f"{time.perf_counter() - started:.1f}s -> {path}")
+
+
+class Layout:
+    def __init__(self, grid_size=GRID_SIZE, width=WINDOW_WIDTH, height=WINDOW_HEIGHT):
+        self.grid_size = grid_size
+        self.version = 0
+        self._font_size = None
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        self.width = max(width, MIN_WINDOW_SIZE[0])
+        self.height = max(height, MIN_WINDOW_SIZE[1])
+        self.scale = min(self.width / WINDOW_WIDTH, self.height / WINDOW_HEIGHT)
+        self.offset_x = (self.width - WINDOW_WIDTH * self.scale) / 2
+        self.offset_y = (self.height - WINDOW_HEIGHT * self.scale) / 2
+        self.header_height = round(HEADER_HEIGHT * self.scale)
+        font_size = round(48 * self.scale)
+        if font_size != self._font_size:
+            self._font_size = font_size
+            self.font = pygame.font.Font(None, font_size)
+            self.button_font = pygame.font.Font(None, round(36 * self.scale))
+        self.set_grid_size(self.grid_size)
+
+    def set_grid_size(self, grid_size):
+        self.grid_size = grid_size
+        side = min(self.width, self.height - self.header_height)
+        self.gap = max(2, side // (grid_size * 11 + 1))
+        self.tile = (side - self.gap * (grid_size + 1)) // grid_size
+        self.board_size = grid_size * (self.tile + self.gap) + self.gap
+        self.board_left = (self.width - self.board_size) // 2
+        self.board_top = self.header_height + (self.height - self.header_height - self.board_size) // 2
+        self.version += 1
+
+    def rect(self, x, y, width, height, anchor="center"):
+        if anchor == "top-right":
+            left = self.width - (WINDOW_WIDTH - x) * self.scale
+            top = y * self.scale
+        else:
+            left = self.offset_x + x * self.scale
+            top = self.offset_y + y * self.scale
+        return pygame.Rect(round(left), round(top), round(width * self.scale), round(height * self.scale))
+
+    def point(self, x, y):
+        return self.offset_x + x * self.scale, self.offset_y + y * self.scale
+
+    def tile_rect(self, r, c):
+        return pygame.Rect(self.board_left + c * (self.tile + self.gap) + self.gap,
+                           self.board_top + r * (self.tile + self.gap) + self.gap, self.tile, self.tile)
+
+    def board_area(self):
+        return pygame.Rect(self.board_left, self.board_top, self.board_size, self.board_size)
+
+
 class Button:
-    def __init__(self, text, x, y, width, height, color, hover_color, font):
+    def __init__(self, text, x, y, width, height, color, hover_color, font, anchor="center"):
         self.text = text
+        self.design_rect = (x, y, width, height)
+        self.anchor = anchor
         self.rect = pygame.Rect(x, y, width, height)
         self.color = color
         self.hover_color = hover_color
         self.font = font
-
-    def draw(self, screen, events):
-        mouse_pos = pygame.mouse.get_pos()
-        mouse_over = self.rect.collidepoint(mouse_pos)
-        clicked = False
+        self._surfaces = {}
+
+    def place(self, layout):
+        self.rect = layout.rect(*self.design_rect, anchor=self.anchor)
+        self.font = layout.button_font
+        self._surfaces.clear()
+
+    def _surface(self, hovered):
+        surface = self._surfaces.get(hovered)
+        if surface is None:
+            surface = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+            current_color = self.hover_color if hovered else self.color
+            pygame.draw.rect(surface, current_color, surface.get_rect(), border_radius=10)
+            text_surface = self.font.render(self.text, True, (0, 0, 0))
+            surface.blit(text_surface, text_surface.get_rect(center=surface.get_rect().center))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self._surfaces[hovered] = surface
+        return surface
+
+    def render(self, screen, hovered):
+        screen.blit(self._surface(hovered), self.rect)
+
+
+class WidgetTree:
+    def __init__(self, layout=None, cell_size=64):
+        self.layout = layout
+        self.layout_version = layout.version if layout is not None else None
+        self.cell_size = cell_size
+        self.widgets = []
+        self.cells = {}
+        self.hovered = None
+        self.dirty = True
+
+    def _index(self, widget):
+        rect = widget.rect
+        for cx in range(rect.left // self.cell_size, (rect.right - 1) // self.cell_size + 1):
+            for cy in range(rect.top // self.cell_size, (rect.bottom - 1) // self.cell_size + 1):
+                self.cells.setdefault((cx, cy), []).append(widget)
+
+    def add(self, widget):
+        if self.layout is not None:
+            widget.place(self.layout)
+        self.widgets.append(widget)
+        self._index(widget)
+        self.update_hover(pygame.mouse.get_pos())
+        return widget
+
+    def relayout(self):
+        self.layout_version = self.layout.version
+        self.cells = {}
+        for widget in self.widgets:
+            widget.place(self.layout)
+            self._index(widget)
+        self.hovered = None
+        self.update_hover(pygame.mouse.get_pos())
+        self.dirty = True
+
+    def hit_test(self, pos):
+        for widget in self.cells.get((pos[0] // self.cell_size, pos[1] // self.cell_size), ()):
+            if widget.rect.collidepoint(pos):
+                return widget
+        return None
+
+    def update_hover(self, pos):
+        widget = self.hit_test(pos)
+        if widget is not self.hovered:
+            self.hovered = widget
+            self.dirty = True
+
+    def handle(self, events):
+        if self.layout is not None and self.layout_version != self.layout.version:
+            self.relayout()
+        clicked = None
         for event in events:
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and mouse_over:
-                clicked = True
-        current_color = self.hover_color if mouse_over else self.color
-        pygame.draw.rect(screen, current_color, self.rect, border_radius=10)
-        text_surface = self.font.render(self.text, True, (0, 0, 0))
-        text_rect = text_surface.get_rect(center=self.rect.center)
-        screen.blit(text_surface, text_rect)
+            if event.type == pygame.MOUSEMOTION:
+                self.update_hover(event.pos)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and clicked is None:
+                clicked = self.hit_test(event.pos)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                self.dirty = True
         return clicked
 
+    def draw(self, screen):
+        for widget in self.widgets:
+            widget.render(screen, widget is self.hovered)
+        self.dirty = False
+
 
 class ThemeManager:
     def __init__(self):
         self.theme_name = "Классическая"
+        self.listeners = []
+
+    def set_theme(self, theme_name):
+        if theme_name != self.theme_name:
+            self.theme_name = theme_name
+            for listener in self.listeners:
+                listener()
 
     def current_theme_settings(self):
         return THEMES[self.theme_name]
@@ -211,274 +2226,1346 @@ class ThemeManager:
             return (255, 255, 255)
 
 
+class TileAtlas:
+    def __init__(self, theme_manager):
+        self.theme_manager = theme_manager
+        self.tiles = {}
+        self.fonts = {}
+        theme_manager.listeners.append(self.clear)
+
+    def clear(self):
+        self.tiles.clear()
+        self.fonts.clear()
+
+    def get(self, value, tile_size):
+        key = (self.theme_manager.theme_name, value, tile_size)
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = self._render(value, tile_size)
+        return tile
+
+    def _render(self, value, tile_size):
+        theme_name = self.theme_manager.theme_name
+        color = THEMES[theme_name]["colors"].get(value, (60, 58, 50))
+        tile = pygame.Surface((tile_size, tile_size), pygame.SRCALPHA)
+        pygame.draw.rect(tile, color, tile.get_rect(), border_radius=min(10, tile_size // 5))
+        if value:
+            font = self.fonts.get(tile_size)
+            if font is None:
+                font = self.fonts[tile_size] = pygame.font.Font(None, round(tile_size * 0.48))
+            text_color = (30, 30, 30) if value < 8 and theme_name == "Классическая" else (255, 255, 255)
+            text_surface = font.render(str(value), True, text_color)
+            tile.blit(text_surface, text_surface.get_rect(center=tile.get_rect().center))
+        if pygame.display.get_surface() is not None:
+            tile = tile.convert_alpha()
+        return tile
+
+
+class TextCache:
+    def __init__(self, capacity=TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+
+    def _lookup(self, key):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def _store(self, key, surface):
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def render(self, text, font, color):
+        key = (text, font, color)
+        surface = self._lookup(key)
+        if surface is None:
+            surface = self._store(key, font.render(text, True, color))
+        return surface
+
+    def render_number(self, prefix, number, font, color):
+        text = f"{prefix}{number}"
+        key = (text, font, color)
+        surface = self._lookup(key)
+        if surface is None:
+            parts = [self.render(prefix, font, color)] + [self.render(digit, font, color) for digit in str(number)]
+            width = sum(part.get_width() for part in parts)
+            surface = pygame.Surface((width, max(part.get_height() for part in parts)), pygame.SRCALPHA)
+            x = 0
+            for part in parts:
+                surface.blit(part, (x, 0))
+                x += part.get_width()
+            surface = self._store(key, surface)
+        return surface
+
+
+class TileAnimator:
+    def __init__(self, duration=ANIMATION_TIME):
+        self.duration = duration
+        self.moves = []
+        self.started = 0.0
+        self.active = False
+
+    def start(self, moves, lead=0.0):
+        # lead сдвигает начало назад, чтобы уже первый кадр показывал плитки в пути
+        self.moves = moves
+        self.started = time.perf_counter() - lead
+        self.active = bool(moves)
+
+    def finish(self):
+        self.moves = []
+        self.active = False
+
+    def progress(self):
+        elapsed = (time.perf_counter() - self.started) / self.duration
+        if elapsed >= 1:
+            self.finish()
+            return 1.0
+        return 1 - (1 - elapsed) ** 2
+
+
+class FrameProfiler:
+    def __init__(self, history=PROFILE_HISTORY):
+        self.enabled = False
+        self.samples = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+        self._frame = None
+        self._last = 0
+        self._panel = None
+        self._stats_at = 0.0
+        self._stats = []
+        self.font = None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._frame = None
+        return self.enabled
+
+    def begin_frame(self):
+        if self.enabled:
+            self._frame = dict.fromkeys(PROFILE_PHASES, 0)
+            self._last = time.perf_counter_ns()
+
+    def mark(self, phase):
+        if self._frame is not None:
+            now = time.perf_counter_ns()
+            self._frame[phase] += now - self._last
+            self._last = now
+
+    def end_frame(self):
+        if self._frame is not None:
+            self.samples.append(tuple(self._frame[phase] for phase in PROFILE_PHASES))
+            self._frame = None
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def percentiles(self):
+        frames = list(self.samples)
+        columns = [[frame[i] for frame in frames] for i in range(len(PROFILE_PHASES))]
+        columns.append([sum(frame) for frame in frames])
+        stats = []
+        for phase, values in zip(PROFILE_PHASES + ("total",), columns):
+            values.sort()
+            if not values:
+                stats.append((phase, 0.0, 0.0))
+                continue
+            p99 = values[min(len(values) - 1, len(values) * 99 // 100)]
+            stats.append((phase, values[len(values) // 2] / 1e6, p99 / 1e6))
+        latencies = sorted(self.latencies)
+        if latencies:
+            p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+            stats.append(("input", latencies[len(latencies) // 2] * 1e3, p99 * 1e3))
+        return stats
+
+    def dump_csv(self, path=None):
+        path = path or time.strftime("frame_profile_%Y%m%d_%H%M%S.csv")
+        with open(path, "w", encoding="utf-8") as csv_file:
+            csv_file.write("frame," + ",".join(f"{phase}_ms" for phase in PROFILE_PHASES) + ",total_ms\n")
+            for number, frame in enumerate(self.samples):
+                csv_file.write(f"{number}," + ",".join(f"{value / 1e6:.4f}" for value in frame) +
+                               f",{sum(frame) / 1e6:.4f}\n")
+        return path
+
+    def draw(self, screen):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+            self._panel = pygame.Surface((220, 166))
+        if time.perf_counter() - self._stats_at > 0.25:
+            self._stats_at = time.perf_counter()
+            self._stats = [self.font.render(f"{phase:<8} p50 {p50:6.2f}  p99 {p99:6.2f} ms", True, (255, 255, 255))
+                           for phase, p50, p99 in self.percentiles()]
+        panel = self._panel
+        panel.fill((20, 20, 20))
+        graph_top, graph_height = 4, 40
+        budget = 1e9 / FPS
+        recent = list(self.samples)[-panel.get_width():]
+        for x, frame in enumerate(recent):
+            total = sum(frame)
+            height = min(graph_height, int(graph_height * total / budget))
+            color = (90, 200, 90) if total <= budget else (220, 70, 70)
+            pygame.draw.line(panel, color, (x, graph_top + graph_height), (x, graph_top + graph_height - height))
+        pygame.draw.line(panel, (120, 120, 120), (0, graph_top), (panel.get_width(), graph_top))
+        for line, surface in enumerate(self._stats):
+            panel.blit(surface, (4, graph_top + graph_height + 4 + line * 16))
+        rect = panel.get_rect(bottomleft=(0, screen.get_height()))
+        screen.blit(panel, rect)
+        return rect
+
+
+class SceneProfiler:
+    def __init__(self, mode="all", interval=SAMPLE_INTERVAL):
+        self.mode = mode
+        self.interval = interval
+        self.scene = None
+        self.profiles = {}
+        self.samples = {}
+        self._profile = None
+        self._stop = threading.Event()
+        self._thread = None
+        if mode in ("all", "sample"):
+            self._thread = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+            self._thread.start()
+
+    def switch(self, scene):
+        if self._profile is not None:
+            self._profile.disable()
+        self.scene = scene
+        if self.mode in ("all", "cprofile"):
+            self._profile = self.profiles.setdefault(scene, cProfile.Profile())
+            self._profile.enable()
+
+    def _sample(self, thread_id):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            scene = self.scene
+            if frame is None or scene is None:
+                continue
+            stack = []
+            leaf = f"{getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}:{frame.f_lineno}"
+            while frame is not None:
+                stack.append(getattr(frame.f_code, "co_qualname", frame.f_code.co_name))
+                frame = frame.f_back
+            key = (tuple(reversed(stack)), leaf)
+            counts = self.samples.setdefault(scene, {})
+            counts[key] = counts.get(key, 0) + 1
+
+    def close(self, directory=None):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        directory = directory or time.strftime("profile_%Y%m%d_%H%M%S")
+        os.makedirs(directory, exist_ok=True)
+        for scene, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, f"{scene}.prof"))
+            with open(os.path.join(directory, f"{scene}.txt"), "w", encoding="utf-8") as report:
+                pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+        for scene, counts in self.samples.items():
+            self._write_samples(os.path.join(directory, scene), counts)
+        return directory
+
+    def _write_samples(self, path, counts):
+        total = sum(counts.values())
+        leaves = {}
+        inclusive = {}
+        # свёрнутые стеки в формате flamegraph.pl, лист — с номером строки
+        with open(path + ".folded", "w", encoding="utf-8") as folded:
+            for (stack, leaf), count in counts.items():
+                folded.write(";".join(stack[:-1] + (leaf,)) + f" {count}\n")
+                leaves[leaf] = leaves.get(leaf, 0) + count
+                for name in set(stack):
+                    inclusive[name] = inclusive.get(name, 0) + count
+        with open(path + ".samples.txt", "w", encoding="utf-8") as report:
+            report.write(f"samples: {total} every {self.interval * 1000:.1f} ms\n\nself (line):\n")
+            for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:PROFILE_REPORT_LINES]:
+                report.write(f"{count / total:7.1%} {count:8d}  {leaf}\n")
+            report.write("\ninclusive:\n")
+            for name, count in sorted(inclusive.items(), key=lambda item: -item[1])[:PROFILE_REPORT_LINES]:
+                report.write(f"{count / total:7.1%} {count:8d}  {name}\n")
+
+
 class UI:
-    def __init__(self, screen, theme_manager, font, button_font):
+    def __init__(self, screen, theme_manager, layout):
         self.screen = screen
         self.theme_manager = theme_manager
-        self.font = font
-        self.button_font = button_font
-
-    def draw_header(self, score, high_score, events):
+        self.layout = layout
+        self.tile_atlas = TileAtlas(theme_manager)
+        self.text_cache = TextCache()
+        self.animator = TileAnimator()
+        self.profiler = FrameProfiler()
+        self.header_widgets = WidgetTree(layout)
+        self.restart_button = self.header_widgets.add(
+            Button("Заново", WINDOW_WIDTH - 230, 30, 100, 40, (220, 220, 220), (200, 200, 200), layout.button_font,
+                   "top-right"))
+        self.exit_button = self.header_widgets.add(
+            Button("Выйти", WINDOW_WIDTH - 110, 30, 100, 40, (220, 220, 220), (200, 200, 200), layout.button_font,
+                   "top-right"))
+        self._drawn = None
+        self.shown_shift = 0.0
+        self._layout_version = layout.version
+        theme_manager.listeners.append(self.invalidate)
+
+    def invalidate(self):
+        self._drawn = None
+
+    def relayout(self, screen):
+        self.screen = screen
+        self.tile_atlas.clear()
+        self.text_cache.surfaces.clear()
+        self.header_widgets.relayout()
+        self.animator.finish()
+        self._layout_version = self.layout.version
+        self.invalidate()
+
+    def score_area(self):
+        return pygame.Rect(0, 0, self.restart_button.rect.left, self.layout.header_height)
+
+    def tile_rect(self, r, c):
+        return self.layout.tile_rect(r, c)
+
+    def board_area(self):
+        return self.layout.board_area()
+
+    def draw_animation(self, progress, background):
+        self.screen.fill(background, self.board_area())
+        empty_tile = self.tile_atlas.get(0, self.layout.tile)
+        for r in range(self.layout.grid_size):
+            for c in range(self.layout.grid_size):
+                self.screen.blit(empty_tile, self.tile_rect(r, c))
+        for source, target, value, _ in self.animator.moves:
+            start = self.tile_rect(*source)
+            end = self.tile_rect(*target)
+            self.screen.blit(self.tile_atlas.get(value, self.layout.tile),
+                             (start.x + (end.x - start.x) * progress, start.y + (end.y - start.y) * progress))
+
+    def draw_score(self, score, high_score):
         text_color = self.theme_manager.get_text_color()
-        score_text = self.button_font.render(f"Счет: {score}", True, text_color)
-        record_text = self.button_font.render(f"Рекорд: {high_score}", True, text_color)
-        self.screen.blit(score_text, (20, 20))
-        self.screen.blit(record_text, (20, 60))
-        restart_button = Button("Заново", WINDOW_WIDTH - 230, 30, 100, 40, (220, 220, 220), (200, 200, 200),
-                                self.button_font)
-        exit_button = Button("Выйти", WINDOW_WIDTH - 110, 30, 100, 40, (220, 220, 220), (200, 200, 200),
-                             self.button_font)
-        restart_clicked = restart_button.draw(self.screen, events)
-        exit_clicked = exit_button.draw(self.screen, events)
-        return restart_clicked, exit_clicked
+        font = self.layout.button_font
+        score_text = self.text_cache.render_number("Счет: ", score, font, text_color)
+        record_text = self.text_cache.render_number("Рекорд: ", high_score, font, text_color)
+        self.screen.blit(score_text, (round(20 * self.layout.scale), round(20 * self.layout.scale)))
+        self.screen.blit(record_text, (round(20 * self.layout.scale), round(60 * self.layout.scale)))
+
+    def draw_header(self, score, high_score):
+        self.draw_score(score, high_score)
+        self.header_widgets.draw(self.screen)
+
+    def draw_game(self, board, score, high_score, events):
+        started = time.perf_counter()
+        buttons = (self.restart_button, self.exit_button)
+        clicked = self.header_widgets.handle(events)
+        clicks = tuple(clicked is button for button in buttons)
+        hover = tuple(self.header_widgets.hovered is button for button in buttons)
+        background = self.theme_manager.current_theme_settings()["background"]
+        if self._layout_version != self.layout.version:
+            self.relayout(pygame.display.get_surface())
+        if any(event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED) for event in events):
+            self._drawn = None
+        if self._drawn is None:
+            self.screen.fill(background)
+            self.draw_header(score, high_score)
+            old_board = None
+            dirty = [self.screen.get_rect()]
+        else:
+            old_board, old_score, old_high_score, old_hover = self._drawn
+            dirty = []
+            if (score, high_score) != (old_score, old_high_score):
+                area = self.score_area()
+                self.screen.fill(background, area)
+                self.draw_score(score, high_score)
+                dirty.append(area)
+            for button, hovered, was_hovered in zip(buttons, hover, old_hover):
+                if hovered != was_hovered:
+                    self.screen.fill(background, button.rect)
+                    button.render(self.screen, hovered)
+                    dirty.append(button.rect)
+        self.profiler.mark("header")
+        progress = self.animator.progress() if self.animator.active else 1.0
+        # смещение плиток на экране в пикселях: по нему сцена понимает, виден ли уже ход
+        self.shown_shift = progress * (self.layout.tile + self.layout.gap)
+        if self.animator.active:
+            self.draw_animation(progress, background)
+            dirty.append(self.board_area())
+            drawn_board = None
+        elif old_board is None:
+            self.screen.fill(background, self.board_area())
+            self.draw_board(board)
+            dirty.append(self.board_area())
+            drawn_board = [row[:] for row in board]
+        else:
+            for r, (row, old_row) in enumerate(zip(board, old_board)):
+                for c, value in enumerate(row):
+                    if value != old_row[c]:
+                        rect = self.tile_rect(r, c)
+                        self.screen.blit(self.tile_atlas.get(value, self.layout.tile), rect)
+                        dirty.append(rect)
+            drawn_board = [row[:] for row in board]
+        self._drawn = (drawn_board, score, high_score, hover)
+        if self.profiler.enabled:
+            dirty.append(self.profiler.draw(self.screen))
+        self.profiler.mark("board")
+        if dirty:
+            pygame.display.update(dirty)
+        self.profiler.mark("present")
+        FRAME_SECONDS.observe(time.perf_counter() - started)
+        return clicks
 
     def draw_board(self, board):
-        theme = self.theme_manager.current_theme_settings()
-        for r in range(GRID_SIZE):
-            for c in range(GRID_SIZE):
-                value = board[r][c]
-                color = theme["colors"].get(value, (60, 58, 50))
-                rect = pygame.Rect(
-                    c * (TILE_DIMENSION + GAP_SIZE) + GAP_SIZE,
-                    HEADER_HEIGHT + r * (TILE_DIMENSION + GAP_SIZE) + GAP_SIZE,
-                    TILE_DIMENSION,
-                    TILE_DIMENSION
-                )
-                pygame.draw.rect(self.screen, color, rect, border_radius=10)
-                if value:
-                    text_color = (30, 30, 30) if value < 8 and self.theme_manager.theme_name == "Классическая" else (
-                        255, 255, 255)
-                    text_surface = self.font.render(str(value), True, text_color)
-                    text_rect = text_surface.get_rect(center=rect.center)
-                    self.screen.blit(text_surface, text_rect)\
+        for r, row in enumerate(board):
+            for c, value in enumerate(row):
+                self.screen.blit(self.tile_atlas.get(value, self.layout.tile), self.tile_rect(r, c))
+
+
+class ReplayRenderer:
+    def __init__(self, theme_name="Классическая", width=WINDOW_WIDTH, height=WINDOW_HEIGHT, grid_size=GRID_SIZE):
+        self.theme_manager = ThemeManager()
+        self.theme_manager.set_theme(theme_name)
+        self.layout = Layout(grid_size, width, height)
+        self.surface = pygame.Surface((self.layout.width, self.layout.height))
+        self.ui = UI(self.surface, self.theme_manager, self.layout)
+
+    def render(self, board, score, high_score):
+        self.surface.fill(self.theme_manager.current_theme_settings()["background"])
+        self.ui.draw_score(score, high_score)
+        self.ui.draw_board(board)
+        return self.surface
+
+    def render_range(self, replay, start, stop, directory):
+        board = Board(replay.grid_size, replay.seed, spawn=replay.spawn)
+        for direction in replay.moves[:start]:
+            board.move(direction)
+        for frame in range(start, stop):
+            # префикс уже довёл поле до кадра start
+            if frame > start:
+                board.move(replay.moves[frame - 1])
+            path = os.path.join(directory, f"frame_{frame:06d}.png")
+            pygame.image.save(self.render(board.board, board.score, replay.score), path)
+        return stop - start
+
+
+_renderers = {}
+
+
+def _init_render_worker():
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    os.environ["SDL_NO_SIGNAL_HANDLERS"] = "1"
+    pygame.display.init()
+    pygame.font.init()
+
+
+def _render_chunk(replay_data, start, stop, directory, theme_name, width, height):
+    replay = Replay.from_bytes(replay_data)
+    key = (theme_name, width, height, replay.grid_size)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        renderer = _renderers[key] = ReplayRenderer(theme_name, width, height, replay.grid_size)
+    return renderer.render_range(replay, start, stop, directory)
+
+
+def render_replay(replay, directory, processes=None, theme_name="Классическая", width=WINDOW_WIDTH,
+                  height=WINDOW_HEIGHT):
+    os.makedirs(directory, exist_ok=True)
+    frames = len(replay.moves) + 1
+    processes = processes or os.cpu_count() or 1
+    chunk = max(1, -(-frames // (processes * 4)))
+    data = replay.to_bytes()
+    jobs = [(data, start, min(start + chunk, frames), directory, theme_name, width, height)
+            for start in range(0, frames, chunk)]
+    pool = multiprocessing.Pool(processes, initializer=_init_render_worker)
+    try:
+        return sum(pool.starmap(_render_chunk, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def check_render(replay, directory, theme_name="Классическая", width=WINDOW_WIDTH, height=WINDOW_HEIGHT):
+    # эталон — один последовательный проход по всему реплею
+    frames = len(replay.moves) + 1
+    reference = tempfile.mkdtemp(prefix="render_check_")
+    pool = multiprocessing.Pool(1, initializer=_init_render_worker)
+    try:
+        pool.apply(_render_chunk, (replay.to_bytes(), 0, frames, reference, theme_name, width, height))
+    finally:
+        pool.close()
+        pool.join()
+    mismatched = []
+    try:
+        for frame in range(frames):
+            name = f"frame_{frame:06d}.png"
+            with open(os.path.join(directory, name), "rb") as chunked, \
+                    open(os.path.join(reference, name), "rb") as sequential:
+                if chunked.read() != sequential.read():
+                    mismatched.append(frame)
+    finally:
+        shutil.rmtree(reference, ignore_errors=True)
+    return mismatched
+
+
+def render_command(archive_path, number, directory, processes=None, theme_name="Классическая",
+                   width=WINDOW_WIDTH, height=WINDOW_HEIGHT, check=False):
+    archive = ReplayArchive(archive_path)
+    replay = archive.get(number)
+    archive.close()
+    started = time.perf_counter()
+    frames = render_replay(replay, directory, processes, theme_name, width, height)
+    elapsed = time.perf_counter() - started
+    print(f"rendered {frames} frames to {directory} in {elapsed:.2f}s ({frames / max(elapsed, 1e-9):.0f} frames/s)")
+    if check:
+        mismatched = check_render(replay, directory, theme_name, width, height)
+        if mismatched:
+            print(f"MISMATCH: {len(mismatched)} frames differ from a sequential pass, first {mismatched[0]}")
+            return False
+        print("chunked frames match a sequential pass")
+    return True
+
+
+class SpectatorWall:
+    def __init__(self, screen, theme_manager, tile_atlas, count=SPECTATOR_BOARDS, grid_size=GRID_SIZE):
+        self.theme_manager = theme_manager
+        self.tile_atlas = tile_atlas
+        self.count = count
+        self.grid_size = grid_size
+        self.columns = math.ceil(math.sqrt(count))
+        self.rows = math.ceil(count / self.columns)
+        self.states = [0] * count
+        self.font = pygame.font.Font(None, SPECTATOR_STATUS_HEIGHT - 4)
+        self.relayout(screen)
+
+    def relayout(self, screen):
+        self.screen = screen
+        width, height = screen.get_size()
+        cell = max(self.grid_size * 4, min(width // self.columns, (height - SPECTATOR_STATUS_HEIGHT) // self.rows))
+        margin = max(2, cell // 16)
+        side = cell - 2 * margin
+        self.gap = max(1, side // (self.grid_size * 11 + 1))
+        self.tile = (side - self.gap * (self.grid_size + 1)) // self.grid_size
+        self.board_size = self.grid_size * (self.tile + self.gap) + self.gap
+        left = (width - cell * self.columns) // 2 + margin
+        top = SPECTATOR_STATUS_HEIGHT + (height - SPECTATOR_STATUS_HEIGHT - cell * self.rows) // 2 + margin
+        self.origins = [(left + (index % self.columns) * cell, top + (index // self.columns) * cell)
+                        for index in range(self.count)]
+        self.drawn = [None] * self.count
+
+    def status_area(self):
+        return pygame.Rect(0, 0, self.screen.get_width(), SPECTATOR_STATUS_HEIGHT)
+
+    def update(self, board_id, packed):
+        self.states[board_id] = packed
+
+    def draw_board(self, board_id):
+        packed = self.states[board_id]
+        x, y = self.origins[board_id]
+        area = pygame.Rect(x, y, self.board_size, self.board_size)
+        self.screen.fill(self.theme_manager.current_theme_settings()["background"], area)
+        step = self.tile + self.gap
+        for index in range(self.grid_size * self.grid_size):
+            exponent = (packed >> (4 * index)) & 0xF
+            tile = self.tile_atlas.get(1 << exponent if exponent else 0, self.tile)
+            self.screen.blit(tile, (x + self.gap + (index % self.grid_size) * step,
+                                    y + self.gap + (index // self.grid_size) * step))
+        self.drawn[board_id] = packed
+        return area
+
+    def draw(self):
+        return [self.draw_board(board_id) for board_id in range(self.count)
+                if self.states[board_id] != self.drawn[board_id]]
+
+
+def _spectator_worker(updates, stop, first, count, grid_size, spawn=CLASSIC_SPAWN):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    updates.cancel_join_thread()
+    engine = PackedEngine.for_size(grid_size)
+    # у каждой доски свой генератор, засеянный её номером
+    streams = [SpawnStream(board_id, SPECTATOR_SPAWN_BATCH) for board_id in range(first, first + count)]
+    boards = [engine.new_game_from(stream, spawn) for stream in streams]
+    pending = dict(enumerate(boards, first))
+    moves = games = 0
+    sent_at = time.perf_counter()
+    while not stop.is_set():
+        for index, packed in enumerate(boards):
+            stream = streams[index]
+            direction = greedy_policy(engine, packed, stream.rng)
+            if direction is None:
+                packed = engine.new_game_from(stream, spawn)
+                games += 1
+            else:
+                packed = engine.spawn_from(engine.move(packed, direction)[0], stream, spawn)
+                moves += 1
+            boards[index] = pending[first + index] = packed
+        now = time.perf_counter()
+        if now - sent_at >= SPECTATOR_INTERVAL:
+            # интерфейс не успевает — состояния копятся в pending, симуляция не ждёт
+            try:
+                updates.put_nowait((moves, games, pending))
+            except queue.Full:
+                continue
+            pending = {}
+            moves = games = 0
+            sent_at = now
+
+
+KEY_DIRECTIONS = {
+    pygame.K_LEFT: 0, pygame.K_a: 0,
+    pygame.K_RIGHT: 1, pygame.K_d: 1,
+    pygame.K_UP: 2, pygame.K_w: 2,
+    pygame.K_DOWN: 3, pygame.K_s: 3,
+}
+KEY_COMMANDS = dict(KEY_DIRECTIONS)
+KEY_COMMANDS.update({pygame.K_z: "undo", pygame.K_BACKSPACE: "undo", pygame.K_y: "redo"})
+
+
+class InputQueue:
+    def __init__(self, capacity=INPUT_QUEUE_SIZE):
+        self.capacity = capacity
+        self.commands = deque()
+        self.held = set()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def clear(self):
+        self.commands.clear()
+        self.held.clear()
+
+    def push(self, events, now):
+        for event in events:
+            if event.type == pygame.KEYUP:
+                self.held.discard(event.key)
+            elif event.type == pygame.KEYDOWN and event.key in KEY_COMMANDS:
+                command = KEY_COMMANDS[event.key]
+                repeat = event.key in self.held
+                self.held.add(event.key)
+                # автоповтор зажатой клавиши не копит очередь
+                if repeat and any(queued == command for queued, _ in self.commands):
+                    continue
+                if len(self.commands) < self.capacity:
+                    self.commands.append((command, now))
+
+    def pop(self):
+        return self.commands.popleft()
+
+
+class Scene:
+    def __init__(self, game):
+        self.game = game
+        self.widgets = WidgetTree(game.layout)
+
+    def enter(self):
+        self.widgets.update_hover(pygame.mouse.get_pos())
+        self.widgets.dirty = True
+
+    def leave(self):
+        pass
+
+    def animating(self):
+        return False
+
+    def add_button(self, text, x, y, width, height, color=(220, 220, 220)):
+        return self.game.add_button(self.widgets, text, x, y, width, height, color)
+
+    def texts(self):
+        return []
+
+    def on_click(self, widget):
+        pass
+
+    def frame(self, events):
+        clicked = self.widgets.handle(events)
+        if clicked is not None:
+            self.on_click(clicked)
+        if not self.game.scene_changed and self.widgets.dirty:
+            self.game.draw_static(self.texts(), self.widgets)
+
+
+class MainMenuScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.has_save = None
+
+    def build(self):
+        self.widgets = WidgetTree(self.game.layout)
+        self.continue_button = None
+        if self.has_save:
+            self.continue_button = self.add_button("Продолжить", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 - 120, 150,
+                                                   50, (240, 240, 240))
+        self.start_button = self.add_button("Начать", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 - 50, 150, 50,
+                                            (240, 240, 240))
+        self.settings_button = self.add_button("Настройки", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 20, 150, 50,
+                                               (240, 240, 240))
+        self.spectate_button = self.add_button("Наблюдение", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 90, 150, 50,
+                                               (240, 240, 240))
+        self.exit_button = self.add_button("Выйти", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 160, 150, 50,
+                                           (240, 240, 240))
+
+    def enter(self):
+        # кнопка «Продолжить» зависит от наличия сохранения
+        has_save = self.game.autosaver.has_save()
+        if has_save != self.has_save:
+            self.has_save = has_save
+            self.build()
+        super().enter()
+
+    def texts(self):
+        return [("2048 ArutKuz", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 4))]
+
+    def on_click(self, widget):
+        if widget is self.continue_button:
+            self.game.switch("game", load_game())
+        elif widget is self.start_button:
+            self.game.switch("game")
+        elif widget is self.settings_button:
+            self.game.switch("settings")
+        elif widget is self.spectate_button:
+            self.game.switch("spectate")
+        elif widget is self.exit_button:
+            self.game.running = False
+
+
+class SettingsScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        y_position = WINDOW_HEIGHT // 4
+        self.targets = {
+            self.add_button("Тема", WINDOW_WIDTH // 2 - 100, y_position, 200, 40): "theme",
+            self.add_button("Рекорд", WINDOW_WIDTH // 2 - 100, y_position + 60, 200, 40): "record",
+            self.add_button("Размер поля", WINDOW_WIDTH // 2 - 100, y_position + 120, 200, 40): "board_size",
+            self.add_button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40): "menu",
+        }
+
+    def texts(self):
+        return [("Настройки", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6))]
+
+    def on_click(self, widget):
+        if widget in self.targets:
+            self.game.switch(self.targets[widget])
+
+
+class ThemeScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.theme_buttons = {}
+        y_position = WINDOW_HEIGHT // 4
+        for theme_name in THEMES:
+            button = self.add_button(theme_name, WINDOW_WIDTH // 2 - 100, y_position, 200, 40)
+            self.theme_buttons[button] = theme_name
+            y_position += 60
+        self.back_button = self.add_button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40)
+
+    def texts(self):
+        return [("Выбор темы", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6))]
+
+    def on_click(self, widget):
+        if widget is self.back_button:
+            self.game.switch("settings")
+        elif widget in self.theme_buttons:
+            self.game.theme_manager.set_theme(self.theme_buttons[widget])
+            self.widgets.dirty = True
+
+
+class BoardSizeScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.size_buttons = {}
+        y_position = WINDOW_HEIGHT // 4
+        for grid_size in BOARD_SIZES:
+            button = self.add_button(f"{grid_size}x{grid_size}", WINDOW_WIDTH // 2 - 100, y_position, 200, 40)
+            self.size_buttons[button] = grid_size
+            y_position += 60
+        self.back_button = self.add_button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40)
+
+    def texts(self):
+        return [("Размер поля", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6)),
+                (f"{self.game.grid_size}x{self.game.grid_size}", (WINDOW_WIDTH / 2, WINDOW_HEIGHT - 140))]
+
+    def on_click(self, widget):
+        if widget is self.back_button:
+            self.game.switch("settings")
+        elif widget in self.size_buttons:
+            self.game.grid_size = self.size_buttons[widget]
+            self.widgets.dirty = True
+
+
+class RecordScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.reset_button = self.add_button("Сбросить", WINDOW_WIDTH // 2 - 100, WINDOW_HEIGHT // 2 + 40, 200, 40)
+        self.back_button = self.add_button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40)
+
+    def texts(self):
+        return [("Рекорд", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6)),
+                ("Рекорд: ", (WINDOW_WIDTH / 2, WINDOW_HEIGHT // 2), self.game.db_manager.high_score)]
 
+    def on_click(self, widget):
+        if widget is self.reset_button:
+            self.game.db_manager.update_high_score(0)
+            self.widgets.dirty = True
+        elif widget is self.back_button:
+            self.game.switch("settings")
+
+
+class GameOverScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.score = 0
+        self.restart_button = self.add_button("Заново", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 40, 150, 50,
+                                              (240, 240, 240))
+        self.exit_button = self.add_button("Выйти", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 100, 150, 50,
+                                           (240, 240, 240))
+        self.menu_button = self.add_button("Меню", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 160, 150, 50,
+                                           (240, 240, 240))
+
+    def enter(self, score=0):
+        self.score = score
+        super().enter()
+
+    def texts(self):
+        return [("Игра окончена", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 4)),
+                ("Ваш счёт: ", (WINDOW_WIDTH / 2, WINDOW_HEIGHT / 2), self.score)]
+
+    def on_click(self, widget):
+        if widget is self.restart_button:
+            self.game.switch("game")
+        elif widget is self.exit_button:
+            self.game.running = False
+        elif widget is self.menu_button:
+            self.game.switch("menu")
+
+
+class GameScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.board = None
+        self.inputs = InputQueue()
+        self.logic_time = 0.0
+        self.unseen = []
+
+    def enter(self, board_obj=None):
+        self.board = self.game.prepare_board(board_obj)
+        self.game.ui.invalidate()
+        self.game.ui.animator.finish()
+        self.inputs.clear()
+        self.unseen = []
+        pygame.key.set_repeat(*KEY_REPEAT)
+
+    def leave(self):
+        self.board = None
+        pygame.key.set_repeat()
+
+    def animating(self):
+        return self.game.ui.animator.active or bool(self.inputs)
+
+    def step(self, command):
+        board_obj, ui = self.board, self.game.ui
+        ui.animator.finish()
+        if command == "undo":
+            changed = board_obj.undo()
+        elif command == "redo":
+            changed = board_obj.redo()
+        else:
+            changed = board_obj.move(command)
+            if changed:
+                ui.animator.start(board_obj.last_moves, 1 / ANIMATION_FPS)
+        if changed:
+            self.game.autosaver.submit(board_obj)
+
+    def finish(self):
+        board_obj = self.board
+        if board_obj.score > self.game.db_manager.high_score:
+            self.game.db_manager.update_high_score(board_obj.score)
+        if not board_obj.assisted:
+            self.game.replay_archive.append(board_obj.to_replay())
+        self.game.autosaver.discard()
+
+    def frame(self, events):
+        game, ui, board_obj = self.game, self.game.ui, self.board
+        now = time.perf_counter()
+        self.inputs.push(events, game.events_at)
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3 and not ui.profiler.toggle():
+                    ui.invalidate()
+                elif event.key == pygame.K_F4:
+                    ui.profiler.dump_csv()
+        # логика идёт фиксированными шагами, по одной команде за шаг;
+        # после простоя первый шаг выполняется сразу, в этом же кадре
+        if self.logic_time < now - MAX_LOGIC_STEPS * LOGIC_STEP:
+            self.logic_time = now
+        game_over = False
+        while self.inputs and self.logic_time <= now and not game_over:
+            command, queued_at = self.inputs.pop()
+            self.step(command)
+            self.unseen.append(queued_at)
+            self.logic_time += LOGIC_STEP
+            if board_obj.is_game_over():
+                self.finish()
+                game_over = True
+
+        ui.profiler.mark("logic")
+        header_buttons = ui.draw_game(board_obj.board, board_obj.score, game.db_manager.high_score, events)
+        presented = time.perf_counter()
+        # задержка считается до кадра, где ход действительно заметен: плитки сдвинулись хотя бы на пиксель
+        if self.unseen and ui.shown_shift >= 1:
+            for queued_at in self.unseen:
+                ui.profiler.record_latency(presented - queued_at)
+            self.unseen = []
+        ui.profiler.end_frame()
+        if game_over or header_buttons[1]:
+            game.switch("game_over", board_obj.score)
+        elif header_buttons[0]:
+            game.switch("game")
+            game.autosaver.submit(self.board)
+
+
+class SpectatorScene(Scene):
+    def __init__(self, game):
+        super().__init__(game)
+        self.workers = []
+        self.updates = self.stop = self.wall = None
+        self.back = "menu"
+
+    def enter(self, count=SPECTATOR_BOARDS, processes=None, back="menu"):
+        self.back = back
+        processes = max(1, min(processes or os.cpu_count() or 1, count))
+        self.updates = multiprocessing.Queue(SPECTATOR_QUEUE_SIZE)
+        self.stop = multiprocessing.Event()
+        for worker_id in range(processes):
+            first = count * worker_id // processes
+            size = count * (worker_id + 1) // processes - first
+            worker = multiprocessing.Process(target=_spectator_worker,
+                                             args=(self.updates, self.stop, first, size, GRID_SIZE, self.game.spawn),
+                                             daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.wall = SpectatorWall(self.game.screen, self.game.theme_manager, self.game.ui.tile_atlas, count)
+        self.moves = self.games = self.moves_per_second = 0
+        self.counted_at = time.perf_counter()
+        self.status = None
+        self.redraw = True
+
+    def leave(self):
+        self.stop.set()
+        for worker in self.workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.updates.close()
+        self.workers = []
+        self.updates = self.stop = self.wall = None
+
+    def animating(self):
+        return True
+
+    def frame(self, events):
+        game, wall = self.game, self.wall
+        for event in events:
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+                if self.back is None:
+                    game.running = False
+                else:
+                    game.switch(self.back)
+                return
+            if event.type == pygame.VIDEOEXPOSE:
+                self.redraw = True
+        while True:
+            try:
+                batch_moves, batch_games, states = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            self.moves += batch_moves
+            self.games += batch_games
+            for board_id, packed in states.items():
+                wall.update(board_id, packed)
+        now = time.perf_counter()
+        if now - self.counted_at >= 1.0:
+            self.moves_per_second = round(self.moves / (now - self.counted_at))
+            self.moves = 0
+            self.counted_at = now
+        background = game.theme_manager.current_theme_settings()["background"]
+        if self.redraw:
+            wall.relayout(game.screen)
+            game.screen.fill(background)
+            self.status = None
+            self.redraw = False
+            dirty = [game.screen.get_rect()]
+        else:
+            dirty = []
+        dirty += wall.draw()
+        if self.status != (self.games, self.moves_per_second):
+            self.status = (self.games, self.moves_per_second)
+            area = wall.status_area()
+            game.screen.fill(background, area)
+            text = game.ui.text_cache.render(f"Партий: {self.games}   Ходов/с: {self.moves_per_second}", wall.font,
+                                             game.theme_manager.get_text_color())
+            game.screen.blit(text, text.get_rect(midleft=(10, area.centery)))
+            dirty.append(area)
+        if dirty:
+            pygame.display.update(dirty)
+
+
+SCRIPT_EVENTS = {
+    "KEYDOWN": pygame.KEYDOWN,
+    "KEYUP": pygame.KEYUP,
+    "MOUSEBUTTONDOWN": pygame.MOUSEBUTTONDOWN,
+    "MOUSEBUTTONUP": pygame.MOUSEBUTTONUP,
+    "MOUSEMOTION": pygame.MOUSEMOTION,
+}
+
+
+class EventRecorder:
+    def __init__(self, path, seed=None):
+        self.path = path
+        self.seed = seed
+        self.frame = 0
+        self.events = []
+
+    def record(self, events):
+        for event in events:
+            for name, event_type in SCRIPT_EVENTS.items():
+                if event.type == event_type:
+                    if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+                        self.events.append([self.frame, name, {"key": event.key}])
+                    elif event_type == pygame.MOUSEMOTION:
+                        self.events.append([self.frame, name, {"pos": list(event.pos)}])
+                    else:
+                        self.events.append([self.frame, name, {"pos": list(event.pos), "button": event.button}])
+        self.frame += 1
+
+    def close(self):
+        script = {"seed": self.seed, "frames": self.frame, "events": self.events}
+        write_atomic(self.path, json.dumps(script).encode("utf-8"))
+
+
+class ScriptedInput:
+    def __init__(self, script, period=1 / ANIMATION_FPS):
+        self.seed = script["seed"]
+        self.frames = script["frames"]
+        self.period = period
+        self.by_frame = {}
+        for frame, name, attributes in script["events"]:
+            self.by_frame.setdefault(frame, []).append((SCRIPT_EVENTS[name], attributes))
+        self.frame = 0
+        self.deadline = None
+        self.frame_started = None
+        self.frame_times = []
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as script_file:
+            return cls(json.load(script_file))
+
+    def _event(self, event_type, attributes):
+        if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+            return pygame.event.Event(event_type, key=attributes["key"], mod=0, unicode="", scancode=0)
+        if event_type == pygame.MOUSEMOTION:
+            return pygame.event.Event(event_type, pos=tuple(attributes["pos"]), rel=(0, 0), buttons=(0, 0, 0))
+        return pygame.event.Event(event_type, pos=tuple(attributes["pos"]), button=attributes["button"])
+
+    def next_frame(self):
+        now = time.perf_counter()
+        if self.frame_started is not None:
+            self.frame_times.append(now - self.frame_started)
+        if self.frame >= self.frames:
+            return [pygame.event.Event(pygame.QUIT)]
+        # кадры идут с частотой анимации, чтобы логика и анимации жили в реальном времени
+        self.deadline = now if self.deadline is None else max(self.deadline + self.period, now)
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        events = [self._event(*event) for event in self.by_frame.get(self.frame, ())]
+        self.frame += 1
+        self.frame_started = time.perf_counter()
+        return events
+
+    def results(self):
+        times = sorted(self.frame_times)
+        return {
+            "frames": len(times),
+            "fps": round(len(times) / sum(times), 1) if times else 0.0,
+            "p99_ms": round(times[min(len(times) - 1, len(times) * 99 // 100)] * 1000, 3) if times else 0.0,
+        }
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, metrics_path=METRICS_PATH, profile_mode=None, script=None, record_path=None,
+                 spawn=CLASSIC_SPAWN):
         pygame.init()
-        self.screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        self.screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
         pygame.display.set_caption("2048 ArutKuz")
-        self.font = pygame.font.Font(None, 48)
-        self.button_font = pygame.font.Font(None, 36)
+        self.layout = Layout()
+        self.grid_size = GRID_SIZE
+        self.spawn = spawn
+        self.pending_size = None
+        self.resize_at = 0.0
         self.clock = pygame.time.Clock()
         self.db_manager = DatabaseManager()
+        self.replay_archive = ReplayArchive()
+        self.autosaver = AutoSaver()
+        self.metrics_writer = MetricsWriter(METRICS, metrics_path)
         self.theme_manager = ThemeManager()
-        self.ui = UI(self.screen, self.theme_manager, self.font, self.button_font)
+        self.ui = UI(self.screen, self.theme_manager, self.layout)
         self.running = True
+        self.event_driven = True
+        self.events_at = 0.0
+        self.script = script
+        self.recorder = EventRecorder(record_path, random.getrandbits(32)) if record_path else None
+        if self.recorder is not None:
+            random.seed(self.recorder.seed)
+        self.scene_profiler = SceneProfiler(profile_mode) if profile_mode else None
+        self.scene = None
+        self.scene_changed = False
+        self.scenes = {
+            "menu": MainMenuScene(self),
+            "settings": SettingsScene(self),
+            "theme": ThemeScene(self),
+            "board_size": BoardSizeScene(self),
+            "record": RecordScene(self),
+            "game": GameScene(self),
+            "game_over": GameOverScene(self),
+            "spectate": SpectatorScene(self),
+        }
 
-    def game_over_screen(self, score):
-        while True:
-            events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-            self.screen.fill(self.theme_manager.current_theme_settings()["background"])
-            title_surface = self.font.render("Игра окончена", True, self.theme_manager.get_text_color())
-            title_rect = title_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 4))
-            self.screen.blit(title_surface, title_rect)
-
-            score_text = self.font.render(f"Ваш счёт: {score}", True, self.theme_manager.get_text_color())
-            score_rect = score_text.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 2))
-            self.screen.blit(score_text, score_rect)
-
-            restart_button = Button("Заново", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 40, 150, 50, (240, 240, 240),
-                                    (200, 200, 200), self.button_font)
-            exit_button = Button("Выйти", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 100, 150, 50, (240, 240, 240),
-                                 (200, 200, 200), self.button_font)
-            menu_button = Button("Меню", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 160, 150, 50, (240, 240, 240),
-                                 (200, 200, 200), self.button_font)
-
-            if restart_button.draw(self.screen, events):
-                return "restart"
-            if exit_button.draw(self.screen, events):
-                return "exit"
-            if menu_button.draw(self.screen, events):
-                return "menu"
-
-            pygame.display.flip()
-            self.clock.tick(60)
-
-    def settings_screen_v2(self):
-        global current_theme
-        while True:
-            events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-            self.screen.fill(THEMES[self.theme_manager.theme_name]["background"])
-            title_surface = self.font.render("Настройки", True, self.theme_manager.get_text_color())
-            title_rect = title_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6))
-            self.screen.blit(title_surface, title_rect)
-
-            y_position = WINDOW_HEIGHT // 4
-            if Button("Тема", WINDOW_WIDTH // 2 - 100, y_position, 200, 40, (220, 220, 220), (200, 200, 200),
-                      self.button_font).draw(self.screen, events):
-                self.theme_settings_screen()
-            y_position += 60
-            if Button("Рекорд", WINDOW_WIDTH // 2 - 100, y_position, 200, 40, (220, 220, 220), (200, 200, 200),
-                      self.button_font).draw(self.screen, events):
-                self.record_settings_screen()
-            y_position += 60
-            if Button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40, (220, 220, 220), (200, 200, 200),
-                      self.button_font).draw(self.screen, events):
-                return
-            pygame.display.flip()
-            self.clock.tick(60)
-
-    def theme_settings_screen(self):
-        global current_theme
-        while True:
-            events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-            self.screen.fill(THEMES[self.theme_manager.theme_name]["background"])
-            title_surface = self.font.render("Выбор темы", True, self.theme_manager.get_text_color())
-            title_rect = title_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6))
-            self.screen.blit(title_surface, title_rect)
-
-            y_position = WINDOW_HEIGHT // 4
-            for theme_name in THEMES:
-                if Button(theme_name, WINDOW_WIDTH // 2 - 100, y_position, 200, 40, (220, 220, 220), (200, 200, 200),
-                          self.button_font).draw(self.screen, events):
-                    self.theme_manager.theme_name = theme_name
-                y_position += 60
-
-            if Button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40, (220, 220, 220), (200, 200, 200),
-                      self.button_font).draw(self.screen, events):
-                return
-            pygame.display.flip()
-            self.clock.tick(60)
-
-    def record_settings_screen(self):
-        while True:
+    def wait_events(self, animating=False):
+        if self.script is not None:
+            events = self.script.next_frame()
+            self.events_at = time.perf_counter()
+            self.ui.profiler.begin_frame()
+        elif not self.event_driven:
+            self.clock.tick(FPS)
+            self.events_at = time.perf_counter()
+            self.ui.profiler.begin_frame()
             events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-            self.screen.fill(THEMES[self.theme_manager.theme_name]["background"])
-            title_surface = self.font.render("Рекорд", True, self.theme_manager.get_text_color())
-            title_rect = title_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 6))
-            self.screen.blit(title_surface, title_rect)
-
-            record_text = self.font.render(f"Рекорд: {self.db_manager.high_score}", True,
-                                           self.theme_manager.get_text_color())
-            record_rect = record_text.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT // 2))
-            self.screen.blit(record_text, record_rect)
-
-            if Button("Сбросить", WINDOW_WIDTH // 2 - 100, WINDOW_HEIGHT // 2 + 40, 200, 40, (220, 220, 220),
-                      (200, 200, 200), self.button_font).draw(self.screen, events):
-                self.db_manager.update_high_score(0)
-                self.db_manager.high_score = 0  
-
-            if Button("Назад", WINDOW_WIDTH // 2 - 50, WINDOW_HEIGHT - 100, 100, 40, (220, 220, 220), (200, 200, 200),
-                      self.button_font).draw(self.screen, events):
-                return
-
-            pygame.display.flip()
-            self.clock.tick(60)
-
-    def main_menu(self):
-        while True:
+        else:
+            timeout = 1000 // ANIMATION_FPS if animating else 0
+            if self.pending_size is not None:
+                remaining = max(1, int((self.resize_at - time.perf_counter()) * 1000))
+                timeout = min(timeout, remaining) if timeout else remaining
+            first = pygame.event.wait(timeout)
+            self.events_at = time.perf_counter()
+            self.ui.profiler.begin_frame()
+            self.clock.tick()
             events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-            self.screen.fill(self.theme_manager.current_theme_settings()["background"])
-            title_surface = self.font.render("2048 ArutKuz", True, self.theme_manager.get_text_color())
-            title_rect = title_surface.get_rect(center=(WINDOW_WIDTH / 2, WINDOW_HEIGHT / 4))
-            self.screen.blit(title_surface, title_rect)
-
-            start_button = Button("Начать", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 - 50, 150, 50, (240, 240, 240),
-                                  (200, 200, 200), self.button_font)
-            settings_button = Button("Настройки", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 20, 150, 50,
-                                     (240, 240, 240),
-                                     (200, 200, 200), self.button_font)
-            exit_button = Button("Выйти", WINDOW_WIDTH / 2 - 75, WINDOW_HEIGHT / 2 + 90, 150, 50, (240, 240, 240),
-                                 (200, 200, 200), self.button_font)
-
-            if start_button.draw(self.screen, events):
-                return "start"
-            if settings_button.draw(self.screen, events):
-                return "settings"
-            if exit_button.draw(self.screen, events):
-                return "exit"
-
-            pygame.display.flip()
-            self.clock.tick(60)
-
-    def run(self):
+            if first.type != pygame.NOEVENT:
+                events.insert(0, first)
+        self.ui.profiler.mark("events")
+        if self.recorder is not None:
+            self.recorder.record(events)
+        for event in events:
+            if event.type == pygame.VIDEORESIZE:
+                self.pending_size = event.size
+                self.resize_at = time.perf_counter() + RESIZE_DELAY
+        if self.pending_size is not None and time.perf_counter() >= self.resize_at:
+            self.apply_resize()
+            events.append(pygame.event.Event(pygame.VIDEOEXPOSE))
+        return events
+
+    def apply_resize(self):
+        width, height = self.pending_size
+        self.pending_size = None
+        if width < MIN_WINDOW_SIZE[0] or height < MIN_WINDOW_SIZE[1]:
+            width, height = max(width, MIN_WINDOW_SIZE[0]), max(height, MIN_WINDOW_SIZE[1])
+            pygame.display.set_mode((width, height), pygame.RESIZABLE)
+        self.layout.resize(width, height)
+        self.screen = pygame.display.get_surface()
+        self.ui.relayout(self.screen)
+
+    def add_button(self, widgets, text, x, y, width, height, color=(220, 220, 220)):
+        return widgets.add(Button(text, x, y, width, height, color, (200, 200, 200), self.layout.button_font))
+
+    def render_text(self, text, center, number=None):
+        color = self.theme_manager.get_text_color()
+        font = self.layout.font
+        if number is None:
+            surface = self.ui.text_cache.render(text, font, color)
+        else:
+            surface = self.ui.text_cache.render_number(text, number, font, color)
+        return surface, surface.get_rect(center=self.layout.point(*center))
+
+    def draw_static(self, texts, widgets):
+        self.screen.fill(self.theme_manager.current_theme_settings()["background"])
+        for text in texts:
+            self.screen.blit(*self.render_text(*text))
+        widgets.draw(self.screen)
+        pygame.display.flip()
+
+    def switch(self, name, *args):
+        if self.scene is not None:
+            self.scene.leave()
+        self.scene = self.scenes[name]
+        if self.scene_profiler is not None:
+            self.scene_profiler.switch(name)
+        self.scene.enter(*args)
+        self.scene_changed = True
+
+    def run(self, name="menu", *args):
+        self.switch(name, *args)
+        events = []
         while self.running:
-            action = self.main_menu()
-            if action == "start":
-                self.run_game()
-            elif action == "settings":
-                self.settings_screen_v2()
-            elif action == "exit":
+            self.scene_changed = False
+            self.scene.frame(events)
+            events = [] if self.scene_changed else self.wait_events(self.scene.animating())
+            if any(event.type == pygame.QUIT for event in events):
                 self.running = False
+        self.quit()
+
+    def quit(self):
+        if self.scene is not None:
+            self.scene.leave()
+            self.scene = None
+        if self.scene_profiler is not None:
+            print(f"профиль сохранён в {self.scene_profiler.close()}")
+        if self.recorder is not None:
+            self.recorder.close()
+        self.autosaver.close()
+        self.metrics_writer.close()
         self.db_manager.close()
+        self.replay_archive.close()
         pygame.quit()
         sys.exit()
 
-    def run_game(self):
-        board_obj = Board()
-        game_active = True
-        while game_active:
-            events = pygame.event.get()
-            for event in events:
-                if event.type == pygame.QUIT:
-                    game_active = False
-                    self.running = False
-
-                if event.type == pygame.KEYDOWN:
-                    old_board = [row[:] for row in board_obj.board]
-                    if event.key in (pygame.K_LEFT, pygame.K_a):
-                        board_obj.move_left()
-                    elif event.key in (pygame.K_RIGHT, pygame.K_d):
-                        board_obj.move_right()
-                    elif event.key in (pygame.K_UP, pygame.K_w):
-                        board_obj.move_up()
-                    elif event.key in (pygame.K_DOWN, pygame.K_s):
-                        board_obj.move_down()
-                    if board_obj.board != old_board:
-                        board_obj.spawn_tile()
-                    if board_obj.is_game_over():
-                        if board_obj.score > self.db_manager.high_score:
-                            self.db_manager.update_high_score(board_obj.score)
-                        game_active = False
-
-            self.screen.fill(self.theme_manager.current_theme_settings()["background"])
-            header_buttons = self.ui.draw_header(board_obj.score, self.db_manager.high_score, events)
-            self.ui.draw_board(board_obj.board)
-            pygame.display.flip()
-            if header_buttons[0]:
-                board_obj = Board()
-            if header_buttons[1]:
-                game_active = False
-            self.clock.tick(60)
-
-        result = self.game_over_screen(board_obj.score)
-
-        if result == "restart":
-            self.run_game()
-        elif result == "exit":
-            self.running = False
-            pygame.quit()
-            sys.exit()
-        elif result == "menu":
-            self.main_menu()
+    def prepare_board(self, board_obj=None):
+        if board_obj is None:
+            board_obj = Board(self.grid_size, undo_capacity=UNDO_CAPACITY, spawn=self.spawn)
+        board_obj.track_moves = True
+        if self.layout.grid_size != board_obj.grid_size:
+            self.layout.set_grid_size(board_obj.grid_size)
+        return board_obj
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def bench_command(script_path, baseline_path=BENCH_BASELINE_PATH, update=False):
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    script = ScriptedInput.load(script_path)
+    baseline_path = os.path.abspath(baseline_path)
+    # база, сохранения и архив пишутся во временный каталог, чтобы прогон был повторяемым
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="2048bench_")
+    os.chdir(workdir)
+    random.seed(script.seed)
+    try:
+        game = Game(script=script)
+        try:
+            game.run()
+        except SystemExit:
+            pass
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    result = script.results()
+    result["peak_rss_mb"] = peak_rss_mb()
+    print(f"{result['frames']} frames: {result['fps']} fps, p99 {result['p99_ms']} ms, "
+          f"peak RSS {result['peak_rss_mb']} MB")
+    if update or not os.path.exists(baseline_path):
+        write_atomic(baseline_path, (json.dumps(result, indent=1) + "\n").encode("utf-8"))
+        print(f"baseline written to {baseline_path}")
+        return True
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    failures = []
+    if result["fps"] < baseline["fps"] * (1 - BENCH_TOLERANCE):
+        failures.append(f"fps {result['fps']} < baseline {baseline['fps']}")
+    if result["p99_ms"] > baseline["p99_ms"] * (1 + BENCH_TOLERANCE):
+        failures.append(f"p99 {result['p99_ms']} ms > baseline {baseline['p99_ms']} ms")
+    if None not in (result["peak_rss_mb"], baseline.get("peak_rss_mb")) and \
+            result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + BENCH_TOLERANCE):
+        failures.append(f"peak RSS {result['peak_rss_mb']} MB > baseline {baseline['peak_rss_mb']} MB")
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    return not failures
 
 
 if __name__ == "__main__":
-    game = Game()
-    game.run()
+    parser = argparse.ArgumentParser(description="2048 ArutKuz")
+    parser.add_argument("--verify", nargs="+", metavar="ARCHIVE", help="проверить реплеи из архивов")
+    parser.add_argument("--verify-server", type=int, nargs="?", const=VERIFY_PORT, metavar="PORT",
+                        help="запустить локальный сервер проверки реплеев")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов проверки")
+    parser.add_argument("--export", metavar="DIR", help="выгрузить траектории в шарды .npy")
+    parser.add_argument("--archive", action="append", default=[], help="архив реплеев для выгрузки")
+    parser.add_argument("--simulate", type=int, default=0, metavar="GAMES", help="число сыгранных партий для выгрузки")
+    parser.add_argument("--policy", default="random", choices=("random", "greedy", "expectimax"),
+                        help="стратегия для сыгранных партий")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="шагов в одном шарде")
+    parser.add_argument("--render", metavar="ARCHIVE", help="отрисовать реплей из архива в PNG-кадры")
+    parser.add_argument("--replay-index", type=int, default=0, help="номер реплея в архиве")
+    parser.add_argument("--out", default="frames", help="каталог для кадров")
+    parser.add_argument("--render-check", action="store_true",
+                        help="сверить кадры по частям с последовательной отрисовкой")
+    parser.add_argument("--theme", default="Классическая", choices=list(THEMES), help="тема оформления")
+    parser.add_argument("--spectate", type=int, nargs="?", const=SPECTATOR_BOARDS, metavar="BOARDS",
+                        help="показать стену из партий бота")
+    parser.add_argument("--metrics-file", default=METRICS_PATH, help="файл метрик для node exporter")
+    parser.add_argument("--profile", nargs="?", const="all", choices=("all", "cprofile", "sample"),
+                        help="профилировать каждый экран и сохранить отчёты при выходе")
+    parser.add_argument("--bench", nargs="?", const=BENCH_SCRIPT_PATH, metavar="SCRIPT",
+                        help="прогнать записанный сценарий без окна и сравнить с эталоном")
+    parser.add_argument("--bench-baseline", default=BENCH_BASELINE_PATH, help="файл эталонных результатов")
+    parser.add_argument("--bench-update", action="store_true", help="перезаписать эталон")
+    parser.add_argument("--record-script", metavar="FILE", help="записать ввод игрока в сценарий")
+    parser.add_argument("--spawn", type=SpawnDistribution.parse, default=CLASSIC_SPAWN, metavar="VALUE:WEIGHT,...",
+                        help="распределение новых плиток, например 2:8,4:1,8:1")
+    parser.add_argument("--spawn-check", type=int, nargs="?", const=10_000_000, metavar="SAMPLES",
+                        help="проверить частоты распределения --spawn на векторной выборке")
+    parser.add_argument("--tablebase", type=int, choices=sorted(TABLEBASE_WIN_TILES), metavar="SIZE",
+                        help="точно решить поле SIZE x SIZE и сохранить таблицу")
+    parser.add_argument("--tablebase-file", help="файл таблицы")
+    parser.add_argument("--win-tile", type=int, help="плитка, на которой партия считается выигранной")
+    parser.add_argument("--tt-file", help="файл общей таблицы транспозиций для expectimax")
+    parser.add_argument("--tt-slots", type=int, default=TT_SLOTS, help="число слотов новой таблицы (степень двойки)")
+    parser.add_argument("--tt-precompute", type=int, nargs="?", const=TT_OPENING_PLIES, metavar="PLIES",
+                        help="заранее просчитать дебютные позиции в таблицу транспозиций")
+    parser.add_argument("--tune", type=int, metavar="GENERATIONS", help="подобрать веса эвристики")
+    parser.add_argument("--population", type=int, default=TUNE_POPULATION, help="кандидатов в поколении")
+    parser.add_argument("--tune-games", type=int, default=TUNE_GAMES, help="партий на кандидата")
+    parser.add_argument("--tune-depth", type=int, default=0, help="глубина expectimax при подборе")
+    parser.add_argument("--tune-checkpoint", default=TUNE_CHECKPOINT, help="файл контрольной точки подбора")
+    parser.add_argument("--frame-size", type=int, nargs=2, default=(WINDOW_WIDTH, WINDOW_HEIGHT),
+                        metavar=("WIDTH", "HEIGHT"), help="размер кадра")
+    args = parser.parse_args()
+    if args.verify:
+        sys.exit(0 if verify_command(args.verify, args.workers) else 1)
+    elif args.export:
+        export_command(args.export, args.archive, args.simulate, args.shard_size, spawn=args.spawn,
+                       policy_name=args.policy, table_path=args.tt_file)
+    elif args.tune:
+        tune_command(args.tune, args.population, args.tune_games, args.workers, args.tune_checkpoint, args.spawn,
+                     args.tune_depth)
+    elif args.tt_precompute:
+        precompute_command(args.tt_file or "transpositions.bin", args.tt_precompute, args.tt_slots, args.workers,
+                           spawn=args.spawn)
+    elif args.bench:
+        sys.exit(0 if bench_command(args.bench, args.bench_baseline, args.bench_update) else 1)
+    elif args.spawn_check is not None:
+        sys.exit(0 if spawn_check_command(args.spawn, args.spawn_check) else 1)
+    elif args.tablebase:
+        tablebase_command(args.tablebase, args.tablebase_file or f"tablebase_{args.tablebase}x{args.tablebase}.bin",
+                          args.win_tile or TABLEBASE_WIN_TILES[args.tablebase])
+    elif args.render:
+        sys.exit(0 if render_command(args.render, args.replay_index, args.out, args.workers, args.theme,
+                                     *args.frame_size, check=args.render_check) else 1)
+    elif args.verify_server is not None:
+        with SubmissionServer(args.verify_server, args.workers) as server:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    elif args.spectate:
+        game = Game(args.metrics_file, args.profile, spawn=args.spawn)
+        game.run("spectate", args.spectate, args.workers, None)
+    else:
+        game = Game(args.metrics_file, args.profile, record_path=args.record_script, spawn=args.spawn)
+        game.run()